@@ -0,0 +1,148 @@
+"""
+blob_store.py — Content-addressed storage for homework screenshots.
+
+Each image is written once as a binary file DATA_DIR/blobs/<sha256>.
+User records keep only {"sha256", "size", "mime"}, and identical uploads
+resolve to the same file, so they are stored once.
+
+BlobSink builds a blob from a stream of chunks (multipart uploads): bytes
+go straight to a temp file while being hashed, the size cap and the image
+magic bytes are checked as they arrive, and commit() renames the file into
+place.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_data_dir = Path(os.getenv("DATA_DIR", "."))
+BLOB_DIR = _data_dir / "blobs"
+BLOB_DIR.mkdir(parents=True, exist_ok=True)
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# Magic-byte signatures of the image formats the Mini App can upload
+_MAGIC = (
+    (b"\xff\xd8\xff",        "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n",   "image/png"),
+    (b"GIF87a",              "image/gif"),
+    (b"GIF89a",              "image/gif"),
+)
+
+
+def sniff_image_mime(head: bytes) -> Optional[str]:
+    """Detect an image MIME type from its first bytes. None if not an image."""
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            return mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def decode_data_url(data_url: str) -> Tuple[bytes, Optional[str]]:
+    """Decode "data:<mime>;base64,<payload>" (or bare base64).
+
+    Returns (bytes, declared_mime). Raises ValueError on malformed base64.
+    """
+    declared = None
+    payload = data_url
+    if data_url.startswith("data:") and "," in data_url:
+        header, payload = data_url.split(",", 1)
+        declared = header[5:].split(";", 1)[0] or None
+    try:
+        data = base64.b64decode(payload.strip(), validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f"invalid base64 payload: {e}") from e
+    if not data:
+        raise ValueError("empty payload")
+    return data, declared
+
+
+def blob_path(sha256: str) -> Path:
+    """Filesystem path of a blob. Raises ValueError on a malformed hash."""
+    if not _SHA256_RE.match(sha256 or ""):
+        raise ValueError("invalid blob hash")
+    return BLOB_DIR / sha256
+
+
+def put_blob(data: bytes, mime: str) -> Dict[str, Any]:
+    """Store bytes by content hash (no-op if already present). Returns blob metadata."""
+    sha = hashlib.sha256(data).hexdigest()
+    path = BLOB_DIR / sha
+    if not path.exists():
+        fd, tmp = tempfile.mkstemp(dir=BLOB_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return {"sha256": sha, "size": len(data), "mime": mime}
+
+
+class BlobTooLarge(ValueError):
+    """Raised by BlobSink.write() once the stream passes its size cap."""
+
+
+class BlobSink:
+    """Incremental blob writer: hashes and spools chunks to a temp file."""
+
+    _HEAD_BYTES = 16   # enough for every signature in _MAGIC and WEBP
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.mime: Optional[str] = None
+        self._head = b""
+        self._hash = hashlib.sha256()
+        fd, self._tmp = tempfile.mkstemp(dir=BLOB_DIR, suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        """Append a chunk. Raises BlobTooLarge / ValueError (not an image) early."""
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise BlobTooLarge(f"blob exceeds {self.max_bytes} bytes")
+        if self.mime is None and len(self._head) < self._HEAD_BYTES:
+            self._head += chunk[:self._HEAD_BYTES - len(self._head)]
+            if len(self._head) >= self._HEAD_BYTES:
+                self._sniff()
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def _sniff(self) -> None:
+        self.mime = sniff_image_mime(self._head)
+        if self.mime is None:
+            raise ValueError("not an image")
+
+    def commit(self) -> Dict[str, Any]:
+        """Move the spooled bytes into the store. Returns blob metadata."""
+        self._file.close()
+        try:
+            if not self.size:
+                raise ValueError("empty payload")
+            if self.mime is None:
+                self._sniff()
+            sha = self._hash.hexdigest()
+            path = BLOB_DIR / sha
+            if path.exists():
+                os.unlink(self._tmp)
+            else:
+                os.replace(self._tmp, path)
+        except Exception:
+            self.discard()
+            raise
+        return {"sha256": sha, "size": self.size, "mime": self.mime}
+
+    def discard(self) -> None:
+        """Drop the temp file (safe to call more than once)."""
+        self._file.close()
+        try:
+            os.unlink(self._tmp)
+        except FileNotFoundError:
+            pass
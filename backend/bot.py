@@ -5,6 +5,8 @@ from dotenv import load_dotenv
 import telebot
 from telebot import types
 
+from outbox import Outbox
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
@@ -24,9 +26,14 @@ def is_admin(uid: int) -> bool:
     return uid in _admin_ids()
 
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown", threaded=False)
+# Every message to a user/chat goes through here; handlers never wait on Telegram
+outbox = Outbox(bot)
 
 MINIAPP_URL = f"{WEBHOOK_URL}/static/index.html" if WEBHOOK_URL else ""
 
+_UNKNOWN_USER_TEXT = "❌ Пользователь не найден"
+_NOT_STARTED_TEXT = "Ты ещё не начал обучение. Открой приложение — Модуль 1 бесплатно:"
+
 
 def make_main_keyboard():
     kb = types.InlineKeyboardMarkup(row_width=1)
@@ -73,9 +80,9 @@ def cmd_app(message: types.Message):
 
 @bot.message_handler(commands=["top"])
 def cmd_top(message: types.Message):
-    from progress import get_leaderboard
+    from progress import get_leaderboard, run_on_loop
     try:
-        board = get_leaderboard(10)
+        board = run_on_loop(get_leaderboard, 10)
         medals = ["🥇", "🥈", "🥉"]
         lines = ["🏆 *Лидерборд CHM Academy:*\n"]
         for i, p in enumerate(board, start=1):
@@ -93,15 +100,24 @@ def cmd_top(message: types.Message):
 
 @bot.message_handler(commands=["stats"])
 def cmd_stats(message: types.Message):
-    from progress import get_user_state, is_deadline_expired, get_deadline_hours_remaining
+    from progress import peek_user_state, is_deadline_expired, get_deadline_hours_remaining, run_on_loop
     from lessons import MODULES
     uid = message.from_user.id
+
+    def snapshot():
+        st = peek_user_state(uid)
+        if st is None:
+            return None
+        return st.to_dict(), get_deadline_hours_remaining(st), is_deadline_expired(st)
+
     try:
-        st = get_user_state(uid)
+        snap = run_on_loop(snapshot)
+        if snap is None:
+            bot.reply_to(message, _NOT_STARTED_TEXT, reply_markup=make_main_keyboard())
+            return
+        st, hours_left, expired = snap
         idx = st.get("module_index", 0)
         mod_title = MODULES[idx]["title"] if idx < len(MODULES) else "Завершено"
-        hours_left = get_deadline_hours_remaining(st)
-        expired = is_deadline_expired(st)
         streak = st.get("streak", 0)
         badges = st.get("badges", [])
 
@@ -142,12 +158,21 @@ def cmd_stats(message: types.Message):
 @bot.message_handler(commands=["deadline"])
 def cmd_deadline(message: types.Message):
     """Show deadline info with rhetoric."""
-    from progress import get_user_state, is_deadline_expired, get_deadline_hours_remaining
+    from progress import peek_user_state, is_deadline_expired, get_deadline_hours_remaining, run_on_loop
     uid = message.from_user.id
+
+    def snapshot():
+        st = peek_user_state(uid)
+        if st is None:
+            return None
+        return get_deadline_hours_remaining(st), is_deadline_expired(st)
+
     try:
-        st = get_user_state(uid)
-        hours_left = get_deadline_hours_remaining(st)
-        expired = is_deadline_expired(st)
+        snap = run_on_loop(snapshot)
+        if snap is None:
+            bot.reply_to(message, _NOT_STARTED_TEXT, reply_markup=make_main_keyboard())
+            return
+        hours_left, expired = snap
 
         if expired:
             bot.reply_to(
@@ -191,8 +216,7 @@ def cmd_deadline(message: types.Message):
 def cmd_extend(message: types.Message):
     if not is_admin(message.from_user.id):
         return
-    from progress import get_user_state, save_progress
-    from datetime import datetime, timedelta
+    from progress import peek_user_state, save_progress, extend_deadline, run_on_loop
     args = message.text.split()[1:]
     if len(args) < 2:
         bot.reply_to(message, "Использование: /extend user_id дни"); return
@@ -200,45 +224,50 @@ def cmd_extend(message: types.Message):
         uid, days = int(args[0]), int(args[1])
     except ValueError:
         bot.reply_to(message, "❌ Неверный формат"); return
-    state = get_user_state(uid)
-    now = datetime.utcnow()
-    dl = state.get("module_deadline")
-    base = datetime.fromisoformat(dl) if dl else now
-    new_dl = base + timedelta(days=days)
-    state["module_deadline"] = new_dl.isoformat()
-    save_progress()
+
+    def extend():
+        state = peek_user_state(uid)
+        if state is None:
+            return None
+        new_dl = extend_deadline(state, days)
+        save_progress(uid)
+        return new_dl
+
+    new_dl = run_on_loop(extend)
+    if new_dl is None:
+        bot.reply_to(message, _UNKNOWN_USER_TEXT); return
     new_date = new_dl.date().isoformat()
     bot.reply_to(message, f"✅ Дедлайн продлён до {new_date}")
-    try:
-        bot.send_message(
-            uid,
-            f"📅 *Дедлайн продлён на {days} дн.*\n"
-            f"Новый дедлайн: {new_date}\n\n"
-            "Используй это время с умом. Рынок не будет ждать вечно."
-        )
-    except Exception as e:
-        logger.warning("Не удалось уведомить пользователя %d о продлении: %s", uid, e)
+    outbox.send_message(
+        uid,
+        f"📅 *Дедлайн продлён на {days} дн.*\n"
+        f"Новый дедлайн: {new_date}\n\n"
+        "Используй это время с умом. Рынок не будет ждать вечно."
+    )
 
 
-@bot.message_handler(commands=["approve"])
-def cmd_approve(message: types.Message):
-    if not is_admin(message.from_user.id):
-        return
-    from progress import get_user_state, save_progress, add_xp, set_module_deadline, DEFAULT_DEADLINE_HOURS
+# Review state changes; handlers run them on the event loop via run_on_loop()
+
+def _approve(uid: int, quest: dict) -> tuple | None:
+    """Approve a homework. Returns (level, leveled_up, advanced, module_index, rank, xp_earned).
+
+    None for an unknown user. A quest already completed awards nothing again.
+    """
+    from progress import peek_user_state, save_progress, add_xp, set_module_deadline, DEFAULT_DEADLINE_HOURS
+    from review_queue import review_queue
     from quests import QUESTS
     from lessons import MODULES
-    args = message.text.split()[1:]
-    if len(args) < 2:
-        bot.reply_to(message, "Использование: /approve user_id quest_id"); return
-    uid, quest_id = int(args[0]), args[1]
-    state = get_user_state(uid)
-    quest = next((q for q in QUESTS if q["id"] == quest_id), None)
-    if not quest:
-        bot.reply_to(message, "❌ Квест не найден"); return
-    if quest_id not in state["completed_quests"]:
-        state["completed_quests"].append(quest_id)
-    state["active_quest"] = None
+    quest_id = quest["id"]
+    state = peek_user_state(uid)
+    if state is None:
+        return None
+    state["active_quest"]    = None
     state["homework_status"] = "approved"
+    if quest_id in state["completed_quests"]:
+        save_progress(uid)
+        review_queue.resolve(uid, quest_id)
+        return state["level"], False, False, state["module_index"], state["rank"], 0
+    state["completed_quests"].append(quest_id)
     level, leveled_up = add_xp(uid, quest["xp_reward"])
     advanced = False
     if quest_id.endswith("_boss"):
@@ -249,12 +278,48 @@ def cmd_approve(message: types.Message):
                 state["module_index"] += 1
                 set_module_deadline(state, hours=DEFAULT_DEADLINE_HOURS)
                 advanced = True
-    save_progress()
+    save_progress(uid)
+    review_queue.resolve(uid, quest_id)
+    return level, leveled_up, advanced, state["module_index"], state["rank"], quest["xp_reward"]
+
+
+def _mark_reviewed(uid: int, quest_id: str, status: str, comment: str | None = None) -> bool:
+    """Set a rejected / revision status (and the comment, if given). False for an unknown user."""
+    from progress import peek_user_state, save_progress
+    from review_queue import review_queue
+    state = peek_user_state(uid)
+    if state is None:
+        return False
+    state["homework_status"] = status
+    if comment is not None:
+        state["homework_comment"] = comment
+    save_progress(uid)
+    review_queue.resolve(uid, quest_id)
+    return True
+
+
+@bot.message_handler(commands=["approve"])
+def cmd_approve(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    from progress import run_on_loop
+    from quests import QUESTS
+    from lessons import MODULES
+    args = message.text.split()[1:]
+    if len(args) < 2:
+        bot.reply_to(message, "Использование: /approve user_id quest_id"); return
+    uid, quest_id = int(args[0]), args[1]
+    quest = next((q for q in QUESTS if q["id"] == quest_id), None)
+    if not quest:
+        bot.reply_to(message, "❌ Квест не найден"); return
+    result = run_on_loop(_approve, uid, quest)
+    if result is None:
+        bot.reply_to(message, _UNKNOWN_USER_TEXT); return
+    level, leveled_up, advanced, new_idx, rank, xp_earned = result
     bot.reply_to(message, f"✅ Квест {quest_id} засчитан пользователю {uid}.")
 
-    notify = f"✅ <b>Домашнее задание принято!</b>\n+{quest['xp_reward']} XP"
+    notify = "✅ <b>Домашнее задание принято!</b>" + (f"\n+{xp_earned} XP" if xp_earned else "")
     if advanced:
-        new_idx = state["module_index"]
         new_mod = MODULES[new_idx]["title"] if new_idx < len(MODULES) else "Завершено"
         notify += (
             f"\n\n🎉 <b>Модуль {new_idx} разблокирован: {_html.escape(new_mod)}</b>\n"
@@ -262,11 +327,8 @@ def cmd_approve(message: types.Message):
             "<i>Биткоин не ждал тебя в 2017. Не будет ждать и сейчас. Начинай.</i>"
         )
     if leveled_up:
-        notify += f"\n⬆️ <b>Новый уровень: {level}!</b>\n<i>{_html.escape(str(state['rank']))}</i>"
-    try:
-        bot.send_message(uid, notify, parse_mode="HTML")
-    except Exception as e:
-        logger.warning("Не удалось уведомить пользователя %d об одобрении: %s", uid, e)
+        notify += f"\n⬆️ <b>Новый уровень: {level}!</b>\n<i>{_html.escape(str(rank))}</i>"
+    outbox.send_message(uid, notify, parse_mode="HTML")
 
 
 @bot.message_handler(commands=["reject"])
@@ -278,7 +340,7 @@ def cmd_reject(message: types.Message):
     """
     if not is_admin(message.from_user.id):
         return
-    from progress import get_user_state, save_progress
+    from progress import run_on_loop
     cmd = message.text.split()[0].lstrip("/")   # "reject" or "revision"
     args = message.text.split(None, 3)[1:]
     if len(args) < 2:
@@ -286,9 +348,8 @@ def cmd_reject(message: types.Message):
     uid, quest_id = int(args[0]), args[1]
     comment = args[2] if len(args) > 2 else "Нужно доработать."
     status = "revision" if cmd == "revision" else "rejected"
-    state = get_user_state(uid)
-    state["homework_status"] = status
-    save_progress()
+    if not run_on_loop(_mark_reviewed, uid, quest_id, status):
+        bot.reply_to(message, _UNKNOWN_USER_TEXT); return
     bot.reply_to(message, f"{'🔄 На доработке' if status == 'revision' else '⛔ Отклонено'}.")
     if status == "revision":
         msg = (
@@ -302,10 +363,7 @@ def cmd_reject(message: types.Message):
             f"Причина:\n<i>{_html.escape(comment)}</i>\n\n"
             "Серьёзные ошибки в структуре. Пересмотри уроки и сделай разметку заново."
         )
-    try:
-        bot.send_message(uid, msg, parse_mode="HTML")
-    except Exception as e:
-        logger.warning("Не удалось уведомить пользователя %d об отклонении: %s", uid, e)
+    outbox.send_message(uid, msg, parse_mode="HTML")
 
 
 @bot.message_handler(commands=["revision"])
@@ -339,7 +397,7 @@ def handle_hw_callback(call: types.CallbackQuery):
 
 
 def _do_hw_callback(call: types.CallbackQuery):
-    from progress import get_user_state, save_progress, add_xp, set_module_deadline, DEFAULT_DEADLINE_HOURS
+    from progress import run_on_loop
     from quests import QUESTS
     from lessons import MODULES
 
@@ -354,7 +412,6 @@ def _do_hw_callback(call: types.CallbackQuery):
 
     action, uid_str, quest_id = parts
     uid = int(uid_str)
-    state = get_user_state(uid)
     quest = next((q for q in QUESTS if q["id"] == quest_id), None)
 
     admin_name = f"@{call.from_user.username}" if call.from_user.username else call.from_user.first_name
@@ -363,25 +420,14 @@ def _do_hw_callback(call: types.CallbackQuery):
         if not quest:
             bot.answer_callback_query(call.id, "❌ Квест не найден", show_alert=True); return
 
-        # ── 1. Answer immediately so Telegram doesn't show spinner ──
-        bot.answer_callback_query(call.id, "✅ Принято!")
+        # ── 1. Update progress, then answer so Telegram drops the spinner ──
+        result = run_on_loop(_approve, uid, quest)
+        if result is None:
+            bot.answer_callback_query(call.id, _UNKNOWN_USER_TEXT, show_alert=True); return
+        level, leveled_up, advanced, new_idx, rank, xp_earned = result
 
-        # ── 2. Update progress ──
-        if quest_id not in state["completed_quests"]:
-            state["completed_quests"].append(quest_id)
-        state["active_quest"]    = None
-        state["homework_status"] = "approved"
-        level, leveled_up = add_xp(uid, quest["xp_reward"])
-        advanced = False
-        idx = state["module_index"]
-        if quest_id.endswith("_boss"):
-            module_quests = [q["id"] for q in QUESTS if q["module_index"] == idx]
-            if all(qid in state["completed_quests"] for qid in module_quests):
-                if idx < len(MODULES) - 1:
-                    state["module_index"] += 1
-                    set_module_deadline(state, hours=DEFAULT_DEADLINE_HOURS)
-                    advanced = True
-        save_progress()
+        # ── 2. Answer ──
+        bot.answer_callback_query(call.id, "✅ Принято!")
 
         # ── 3. Remove buttons + mark message ──
         done_text = f"✅ <b>Принято</b> — {_html.escape(admin_name)}"
@@ -390,15 +436,11 @@ def _do_hw_callback(call: types.CallbackQuery):
                 call.message.chat.id, call.message.message_id, reply_markup=None)
         except Exception as e:
             logger.warning(f"edit_markup approve: {e}")
-        try:
-            bot.send_message(call.message.chat.id, done_text, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"send done_text approve: {e}")
+        outbox.send_message(call.message.chat.id, done_text, parse_mode="HTML")
 
         # ── 4. Notify student ──
-        notify = f"✅ <b>Домашнее задание принято!</b>\n+{quest['xp_reward']} XP"
+        notify = "✅ <b>Домашнее задание принято!</b>" + (f"\n+{xp_earned} XP" if xp_earned else "")
         if advanced:
-            new_idx = state["module_index"]
             new_mod = MODULES[new_idx]["title"] if new_idx < len(MODULES) else "Завершено"
             notify += (
                 f"\n\n🎉 <b>Модуль {new_idx} разблокирован: {_html.escape(new_mod)}</b>\n"
@@ -406,24 +448,20 @@ def _do_hw_callback(call: types.CallbackQuery):
                 "<i>Биткоин не ждал тебя в 2017. Не будет ждать и сейчас. Начинай.</i>"
             )
         if leveled_up:
-            notify += f"\n⬆️ <b>Новый уровень: {level}!</b>\n<i>{_html.escape(str(state['rank']))}</i>"
-        try:
-            bot.send_message(uid, notify, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"notify student approve: {e}")
+            notify += f"\n⬆️ <b>Новый уровень: {level}!</b>\n<i>{_html.escape(str(rank))}</i>"
+        outbox.send_message(uid, notify, parse_mode="HTML")
 
     elif action in ("hw_rv", "hw_rj"):
         status          = "revision" if action == "hw_rv" else "rejected"
         label           = "🔄 На доработку" if status == "revision" else "⛔ Отклонено"
         default_comment = "Нужно доработать." if status == "revision" else "Не принято."
 
-        # ── 1. Answer immediately ──
-        bot.answer_callback_query(call.id, label)
+        # ── 1. Update progress ──
+        if not run_on_loop(_mark_reviewed, uid, quest_id, status, default_comment):
+            bot.answer_callback_query(call.id, _UNKNOWN_USER_TEXT, show_alert=True); return
 
-        # ── 2. Update progress ──
-        state["homework_status"]  = status
-        state["homework_comment"] = default_comment
-        save_progress()
+        # ── 2. Answer ──
+        bot.answer_callback_query(call.id, label)
 
         # ── 3. Remove buttons + hint in group ──
         hint = (
@@ -437,10 +475,7 @@ def _do_hw_callback(call: types.CallbackQuery):
                 call.message.chat.id, call.message.message_id, reply_markup=None)
         except Exception as e:
             logger.warning(f"edit_markup {status}: {e}")
-        try:
-            bot.send_message(call.message.chat.id, hint, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"send hint {status}: {e}")
+        outbox.send_message(call.message.chat.id, hint, parse_mode="HTML")
 
         # ── 4. Notify student ──
         if status == "revision":
@@ -455,10 +490,7 @@ def _do_hw_callback(call: types.CallbackQuery):
                 f"Причина:\n<i>{_html.escape(default_comment)}</i>\n\n"
                 "Пересмотри уроки и сделай разметку заново."
             )
-        try:
-            bot.send_message(uid, msg, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"notify student {status}: {e}")
+        outbox.send_message(uid, msg, parse_mode="HTML")
 
 
 def setup_webhook():
@@ -486,11 +518,9 @@ def setup_webhook():
 
 
 def process_update(update_dict: dict):
-    try:
-        update = telebot.types.Update.de_json(update_dict)
-        bot.process_new_updates([update])
-    except Exception as e:
-        logger.error(f"Ошибка обработки апдейта: {e}")
+    """Run the handlers for one update. Errors propagate, so the inbox keeps the update."""
+    update = telebot.types.Update.de_json(update_dict)
+    bot.process_new_updates([update])
 
 
 def notify_deadline_warning(user_id: int, hours_left: float):
@@ -498,7 +528,7 @@ def notify_deadline_warning(user_id: int, hours_left: float):
     try:
         if hours_left <= 1:
             mins = int(hours_left * 60)
-            bot.send_message(
+            outbox.send_message(
                 user_id,
                 f"🚨 *ПОСЛЕДНИЙ ЧАС — {mins} МИНУТ!*\n\n"
                 "Красный экран. Таймер идёт.\n"
@@ -506,7 +536,7 @@ def notify_deadline_warning(user_id: int, hours_left: float):
                 reply_markup=make_main_keyboard(),
             )
         elif hours_left <= 6:
-            bot.send_message(
+            outbox.send_message(
                 user_id,
                 f"⚠️ *До дедлайна {hours_left:.0f} часов. Последний шанс.*\n\n"
                 "Рынок не ждал никого — и мы тоже.\n"
@@ -514,7 +544,7 @@ def notify_deadline_warning(user_id: int, hours_left: float):
                 reply_markup=make_main_keyboard(),
             )
         elif hours_left <= 24:
-            bot.send_message(
+            outbox.send_message(
                 user_id,
                 f"⏰ *Напоминание: до дедлайна {hours_left:.0f} часов.*\n\n"
                 "Каждый час промедления — это потерянный сетап на реальном рынке.\n"
@@ -527,13 +557,10 @@ def notify_deadline_warning(user_id: int, hours_left: float):
 
 def notify_inactivity(user_id: int, user_name: str):
     """Notify user after 48+ hours of inactivity."""
-    try:
-        bot.send_message(
-            user_id,
-            f"Эй, *{user_name}*. Пока ты отдыхал — биткоин сделал несколько сетапов "
-            f"по системе, которую ты ещё не изучил.\n\n"
-            f"Вернись. Дедлайн тикает. Рынок не будет ждать.",
-            reply_markup=make_main_keyboard(),
-        )
-    except Exception as e:
-        logger.error(f"Ошибка уведомления о неактивности {user_id}: {e}")
+    outbox.send_message(
+        user_id,
+        f"Эй, *{user_name}*. Пока ты отдыхал — биткоин сделал несколько сетапов "
+        f"по системе, которую ты ещё не изучил.\n\n"
+        f"Вернись. Дедлайн тикает. Рынок не будет ждать.",
+        reply_markup=make_main_keyboard(),
+    )
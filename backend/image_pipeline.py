@@ -0,0 +1,113 @@
+"""
+image_pipeline.py — Downscaled renditions of homework screenshots.
+
+Each stored photo blob gets two JPEG renditions written next to it in the
+blob directory:
+  <sha256>.preview.jpg — longest side ≤ 1280 px, for review and Telegram
+  <sha256>.thumb.jpg   — longest side ≤ 256 px, for admin lists
+
+The renditions are rendered on a small thread pool when the homework is
+submitted, so the request never waits on Pillow. They are derived data. If
+one is missing (older blobs, Pillow not installed, an image that would not
+decode), callers serve the original instead.
+"""
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from blob_store import blob_path
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+    # Screenshots are a few megapixels; refuse anything absurd outright
+    Image.MAX_IMAGE_PIXELS = 40_000_000
+except ImportError:   # Pillow is optional: without it only originals are served
+    Image = ImageOps = None
+
+# kind → (max side in px, JPEG quality)
+RENDITIONS: Dict[str, tuple] = {
+    "preview": (1280, 82),
+    "thumb":   (256, 70),
+}
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+_pool: Optional[ThreadPoolExecutor] = None
+_inflight: Dict[str, Future] = {}   # sha256 → pending render
+_lock = threading.Lock()
+
+
+def rendition_path(sha256: str, kind: str) -> Path:
+    """Where a rendition of a blob lives. Raises ValueError on a bad hash or kind."""
+    if kind not in RENDITIONS:
+        raise ValueError(f"unknown rendition {kind!r}")
+    original = blob_path(sha256)
+    return original.with_name(f"{original.name}.{kind}.jpg")
+
+
+def render(sha256: str) -> None:
+    """Write every missing rendition of one blob (blocking)."""
+    missing = [kind for kind in RENDITIONS if not rendition_path(sha256, kind).exists()]
+    if not missing or Image is None:
+        return
+    with Image.open(blob_path(sha256)) as src:
+        # Let the JPEG decoder downscale while decoding; a no-op for PNG/WebP
+        src.draft("RGB", (RENDITIONS["preview"][0],) * 2)
+        img = ImageOps.exif_transpose(src).convert("RGB")
+    # Largest first, so each smaller rendition is cut from the previous one
+    for kind in sorted(missing, key=lambda k: -RENDITIONS[k][0]):
+        side, quality = RENDITIONS[kind]
+        img.thumbnail((side, side), Image.LANCZOS)
+        path = rendition_path(sha256, kind)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, "JPEG", quality=quality, optimize=True)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+def _render_logged(sha256: str) -> None:
+    try:
+        render(sha256)
+    except Exception as e:
+        logger.warning("Превью для %s не построено: %s", sha256[:12], e)
+
+
+def schedule(photo: Optional[Dict[str, Any]]) -> Optional[Future]:
+    """Queue rendering for a photo blob. Returns the Future (shared per blob), or None."""
+    global _pool
+    if not photo or Image is None:
+        return None
+    sha = photo["sha256"]
+    with _lock:
+        fut = _inflight.get(sha)
+        if fut is not None:
+            return fut
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+        fut = _pool.submit(_render_logged, sha)
+        _inflight[sha] = fut
+    fut.add_done_callback(lambda _f: _inflight.pop(sha, None))
+    return fut
+
+
+def pending(sha256: str) -> Optional[Future]:
+    """The in-flight render for a blob, if there is one."""
+    return _inflight.get(sha256)
+
+
+def shutdown() -> None:
+    """Stop the worker pool; unfinished renders are simply redone on demand."""
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
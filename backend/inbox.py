@@ -0,0 +1,198 @@
+"""
+inbox.py — Durable inbox for Telegram webhook updates.
+
+The webhook only has to persist an update and answer. accept() writes the
+raw JSON to DATA_DIR/inbox/<update_id>.json (temp file, fsync, rename),
+drops update_ids it has already seen (Telegram redelivers whatever it
+thinks went unacknowledged), and hands the update to a worker. The webhook
+runs accept() in the executor and answers 5xx if the write fails, so an
+update is acknowledged only once it is on disk.
+
+Workers are sharded by chat: every update for one chat lands on the same
+worker queue, so one chat's updates run in the order they were accepted
+while different chats run in parallel. That order is best-effort: accept()
+runs concurrently in the executor, so two updates for one chat that arrive
+at the same moment can be queued in either order. Telegram sends a chat's
+updates one at a time unless an earlier one went unacknowledged, so this is
+rare. Handlers touch progress state only through progress.run_on_loop(), so
+the workers never race the request handlers.
+
+A file is deleted once its update has been handled successfully. If the
+handler raises, the file moves to inbox/failed/ for inspection. It is not
+retried, since the handler may have half-applied it. Whatever is still in
+the inbox at startup was never handled, and start() replays it in
+update_id order.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Set
+
+logger = logging.getLogger(__name__)
+
+_data_dir = Path(os.getenv("DATA_DIR", "."))
+INBOX_DIR = _data_dir / "inbox"
+FAILED_SUBDIR = "failed"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+SEEN_WINDOW = 10_000   # recent update_ids remembered for dedupe
+
+
+def _chat_key(update: Dict[str, Any]) -> int:
+    """Chat an update belongs to (its ordering key); 0 if it has none."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+        sender = value.get("from")
+        if sender and "id" in sender:
+            return int(sender["id"])
+    return 0
+
+
+class UpdateInbox:
+    """On-disk queue of webhook updates, drained by per-chat ordered workers."""
+
+    def __init__(self, path: Path, handler: Callable[[Dict[str, Any]], None],
+                 workers: int = WEBHOOK_WORKERS):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.handler = handler
+        self._queues: List[queue.Queue] = [queue.Queue() for _ in range(max(1, workers))]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._seen: Set[int] = set()
+        self._seen_order: Deque[int] = deque()
+        self._writing: Set[int] = set()   # ids being persisted by accept()
+        self._pending = 0
+
+    def __len__(self) -> int:
+        """Updates accepted but not yet handled."""
+        return self._pending
+
+    # ── lifecycle ────────────────────────────────────────────────────────────
+
+    def start(self) -> int:
+        """Start the workers and replay updates left on disk. Returns the number replayed."""
+        if not self._threads:
+            self._threads = [
+                threading.Thread(target=self._worker, args=(q,), name=f"inbox-{i}", daemon=True)
+                for i, q in enumerate(self._queues)
+            ]
+            for t in self._threads:
+                t.start()
+        replayed = 0
+        for file in sorted(self.path.glob("*.json"), key=self._file_order):
+            try:
+                update = json.loads(file.read_text(encoding="utf-8"))
+                update_id = int(update["update_id"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning("Входящий апдейт %s повреждён, удалён: %s", file.name, e)
+                file.unlink(missing_ok=True)
+                continue
+            if self._remember(update_id):
+                self._dispatch(update_id, update)
+                replayed += 1
+        if replayed:
+            logger.info("Входящие апдейты восстановлены с диска: %d", replayed)
+        return replayed
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Let workers finish what is queued (up to `timeout` each); the rest stays on disk."""
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    # ── public API ───────────────────────────────────────────────────────────
+
+    def accept(self, update: Dict[str, Any]) -> bool:
+        """Persist and queue one update. Returns False for a duplicate update_id.
+
+        The update_id only counts as seen once its file is in place. If the
+        write fails the error propagates, so the webhook can answer 5xx and
+        Telegram redelivers. Blocks on fsync: call it off the event loop.
+        """
+        update_id = int(update["update_id"])
+        with self._lock:
+            if update_id in self._seen or update_id in self._writing:
+                return False
+            self._writing.add(update_id)
+        try:
+            path = self._file(update_id)
+            tmp = path.with_suffix(".tmp")
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(update, f, ensure_ascii=False, separators=(",", ":"))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+            self._remember(update_id)
+        finally:
+            with self._lock:
+                self._writing.discard(update_id)
+        self._dispatch(update_id, update)
+        return True
+
+    # ── internals ────────────────────────────────────────────────────────────
+
+    def _file(self, update_id: int) -> Path:
+        return self.path / f"{update_id}.json"
+
+    @staticmethod
+    def _file_order(file: Path) -> int:
+        try:
+            return int(file.stem)
+        except ValueError:
+            return -1
+
+    def _remember(self, update_id: int) -> bool:
+        """Record an update_id; False if it is already in the dedupe window."""
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen.add(update_id)
+            self._seen_order.append(update_id)
+            if len(self._seen_order) > SEEN_WINDOW:
+                self._seen.discard(self._seen_order.popleft())
+            return True
+
+    def _dispatch(self, update_id: int, update: Dict[str, Any]) -> None:
+        with self._lock:
+            self._pending += 1
+        self._queues[_chat_key(update) % len(self._queues)].put((update_id, update))
+
+    def _worker(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            update_id, update = item
+            try:
+                self.handler(update)
+            except Exception as e:
+                logger.error("Ошибка обработки апдейта %d: %s", update_id, e, exc_info=True)
+                self._set_aside(update_id)
+            else:
+                self._file(update_id).unlink(missing_ok=True)
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+    def _set_aside(self, update_id: int) -> None:
+        """Move a failed update's file to inbox/failed/ (kept, never replayed)."""
+        failed = self.path / FAILED_SUBDIR
+        try:
+            failed.mkdir(exist_ok=True)
+            os.replace(self._file(update_id), failed / f"{update_id}.json")
+        except OSError as e:
+            logger.error("Апдейт %d не перенесён в %s: %s", update_id, FAILED_SUBDIR, e)
@@ -1,19 +1,21 @@
 import asyncio
+import csv
 import html as _html
 import io
+import json
 import os
 import base64
 import logging
 import random
 from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Optional
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from datetime import datetime
 
 from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response, JSONResponse
+from fastapi.responses import FileResponse, Response, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
@@ -25,39 +27,65 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 from progress import (
-    get_user_state, save_progress, add_xp,
+    get_user_state, peek_user_state, save_progress, add_xp,
     set_module_deadline, is_deadline_expired,
-    reset_user_progress, get_leaderboard,
-    user_progress, load_progress,
+    reset_user_progress, get_leaderboard, get_user_rank,
+    leaderboard_version, touch_leaderboard, query_users, ADMIN_SORT_FIELDS, admin_summary,
+    export_row, EXPORT_COLUMNS, EXPORT_DEFAULT_COLUMNS,
+    user_progress, load_progress, start_compaction_loop, transaction,
+    start_period_badge_loop, start_reminder_loop, extend_deadline, LEADERBOARD_PERIODS,
+    start_background_flush, stop_background_flush,
     MAX_EXTENSIONS, DEFAULT_DEADLINE_HOURS,
     update_streak, claim_daily_bonus, award_badge,
     get_deadline_hours_remaining, apply_penalty_extension,
     MODULE_PENALTIES, MODULE_FULL_REPURCHASE,
     BADGE_DEFS, SMC_LEVELS, get_level_and_rank,
     # Pet system
-    get_pet_state, pet_register_tap, apply_lesson_pet_effect, add_pet_coins,
+    peek_pet_state, pet_register_tap, apply_lesson_pet_effect, add_pet_coins,
     PET_LEVEL_XP,
     # Evolution + DNA
     check_and_update_evolution, EVOLUTION_STAGES, update_trader_dna, get_trader_dna,
 )
+from blob_store import BlobTooLarge, blob_path, decode_data_url, put_blob, sniff_image_mime
+from review_queue import review_queue
+from uploads import read_upload
+from inbox import INBOX_DIR, UpdateInbox
+import image_pipeline
+from user_state import UserState
 from market_feed import refresh_market_data, start_market_feed_loop, get_cached_pulse
 from oracle_engine import generate_oracle
 from dream_generator import generate_dream
 from lessons import LESSONS, MODULES
 from quests import QUESTS, QUIZZES
 from charts import generate_chart
-from bot import bot as telegram_bot, setup_webhook, process_update, make_hw_keyboard
+from bot import (
+    outbox, setup_webhook, process_update, make_hw_keyboard,
+    notify_deadline_warning, notify_inactivity,
+)
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
-    """Application lifespan: load data on startup."""
+    """Application lifespan: load data on startup, flush pending saves on shutdown."""
     load_progress()
     logger.info("Progress loaded: %d users", len(user_progress))
+    start_background_flush()
+    # Updates persisted but not handled before the last shutdown run first
+    update_inbox.start()
     if os.getenv("WEBHOOK_URL"):
         setup_webhook()
     else:
         logger.info("WEBHOOK_URL not set — webhook not configured (polling mode)")
+    compaction = asyncio.create_task(start_compaction_loop())
+    period_badges = asyncio.create_task(start_period_badge_loop())
+    reminders = asyncio.create_task(start_reminder_loop(notify_deadline_warning, notify_inactivity))
     yield
+    reminders.cancel()
+    period_badges.cancel()
+    compaction.cancel()
+    await asyncio.get_running_loop().run_in_executor(None, update_inbox.stop)
+    image_pipeline.shutdown()
+    await asyncio.get_running_loop().run_in_executor(None, outbox.stop)
+    stop_background_flush()
 
 app = FastAPI(title="CHM Smart Money Academy API", version="4.0.0", lifespan=lifespan)
 
@@ -120,6 +148,18 @@ class ExtendRequest(BaseModel):
     days: int = 2
 
 
+class AdminDecision(BaseModel):
+    user_id: int
+    quest_id: str
+    action: str                       # "approve", "reject" or "revision"
+    comment: Optional[str] = None
+
+
+class AdminBulkRequest(BaseModel):
+    admin_id: int
+    decisions: List[AdminDecision]
+
+
 class PenaltyPaymentRequest(BaseModel):
     user_id: int
     module_index: int
@@ -143,6 +183,10 @@ class DreamAnswerRequest(BaseModel):
 
 # ── UTILS ─────────────────────────────────────────────────────────────────────
 
+MAX_PHOTO_BYTES = 1_500_000   # decoded homework screenshot limit
+MAX_BULK_DECISIONS = 200      # per /api/admin/bulk request
+PREVIEW_WAIT_SECS = 3.0       # how long a request waits for a rendition before using the original
+
 _cached_admin_ids: set = set()
 
 def _get_admin_ids() -> set:
@@ -160,21 +204,71 @@ def _get_admin_channel_id() -> int | None:
     except ValueError:
         return None
 
-def _send_hw_notification(chat_id: int, admin_text: str, photo_b64: str | None,
-                          user_id: int, quest_id: str) -> None:
-    """Send homework notification to a chat/channel with inline buttons and photo fallback."""
+def _broadcast_homework(chat_ids: List[int], admin_text: str, photo: bytes | str | None,
+                        user_id: int, quest_id: str, submission_id: int,
+                        photo_sha: str | None = None) -> None:
+    """Queue one notification per reviewer chat, uploading the photo at most once.
+
+    `photo` is raw bytes or a Telegram file_id. Bytes go to one chat at a
+    time until a send_photo succeeds. Its file_id is stored for the blob
+    `photo_sha`, and every remaining chat gets that id instead. A chat whose
+    photo send fails gets the text alone.
+    """
     kb = make_hw_keyboard(user_id, quest_id)
-    if photo_b64:
-        photo_bytes = base64.b64decode(photo_b64.split(",", 1)[-1])
-        buf = io.BytesIO(photo_bytes)
-        buf.name = "homework.jpg"
-        try:
-            telegram_bot.send_photo(chat_id, buf, caption=admin_text, parse_mode="HTML",
-                                    reply_markup=kb)
+    if isinstance(photo, str) and photo_sha:
+        review_queue.set_file_id(submission_id, photo_sha, photo)
+
+    def send_text(chat_id: int) -> None:
+        outbox.send_message(chat_id, admin_text, parse_mode="HTML", reply_markup=kb)
+
+    def send_from(i: int, photo: bytes | str | None) -> None:
+        if i >= len(chat_ids):
             return
-        except Exception as e:
-            logger.error(f"send_photo to {chat_id}: {e}")
-    telegram_bot.send_message(chat_id, admin_text, parse_mode="HTML", reply_markup=kb)
+        if not photo or isinstance(photo, str):
+            for cid in chat_ids[i:]:
+                if photo:
+                    outbox.send("send_photo", cid, photo, caption=admin_text, parse_mode="HTML",
+                                reply_markup=kb, on_error=lambda _e, cid=cid: send_text(cid))
+                else:
+                    send_text(cid)
+            return
+
+        def uploaded(msg) -> None:
+            file_id = msg.photo[-1].file_id if getattr(msg, "photo", None) else None
+            if file_id and photo_sha:
+                review_queue.set_file_id(submission_id, photo_sha, file_id)
+            send_from(i + 1, file_id or photo)
+
+        def failed(_exc: Exception) -> None:
+            send_text(chat_ids[i])
+            send_from(i + 1, photo)
+
+        outbox.send("send_photo", chat_ids[i], photo, caption=admin_text, parse_mode="HTML",
+                    reply_markup=kb, on_done=uploaded, on_error=failed)
+
+    send_from(0, photo)
+
+
+async def _photo_file(photo: dict, size: str = "full", wait: float = PREVIEW_WAIT_SECS):
+    """(path, mime) of a homework photo rendition, falling back to the original blob.
+
+    A missing rendition is (re)scheduled on the image pool and awaited for
+    up to `wait` seconds. Raises ValueError on a malformed blob hash.
+    """
+    original = blob_path(photo["sha256"])
+    if size != "full":
+        path = image_pipeline.rendition_path(photo["sha256"], size)
+        if not path.exists():
+            fut = image_pipeline.schedule(photo)
+            if fut is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), wait)
+                except asyncio.TimeoutError:
+                    pass
+        if path.exists():
+            return path, "image/jpeg"
+    return original, photo.get("mime", "application/octet-stream")
+
 
 def check_admin(admin_id: int):
     """Raise 403 if admin_id is not in the allowed admin set."""
@@ -182,6 +276,14 @@ def check_admin(admin_id: int):
         raise HTTPException(status_code=403, detail="Нет доступа")
 
 
+def require_user(user_id: int) -> UserState:
+    """Return an existing user's state or raise 404. Never creates a record."""
+    state = peek_user_state(user_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return state
+
+
 # ── CHART CACHE (TTL-based, avoids regenerating expensive matplotlib charts) ─
 _chart_cache: dict = {}
 _CHART_CACHE_TTL = 3600  # 1 hour
@@ -189,7 +291,9 @@ _CHART_CACHE_TTL = 3600  # 1 hour
 
 def try_advance_module(user_id: int) -> bool:
     """Advance user to next module if all current module quests are completed."""
-    state = get_user_state(user_id)
+    state = peek_user_state(user_id)
+    if state is None:
+        return False
     idx = state["module_index"]
     if idx >= len(MODULES) - 1:
         return False
@@ -198,7 +302,7 @@ def try_advance_module(user_id: int) -> bool:
     if all(qid in completed for qid in module_quests):
         state["module_index"] += 1
         set_module_deadline(state, hours=DEFAULT_DEADLINE_HOURS)
-        save_progress()
+        save_progress(user_id)
         return True
     return False
 
@@ -262,7 +366,9 @@ async def user_init(req: UserInitRequest):
         or f"{req.first_name or ''} {req.last_name or ''}".strip()
         or str(req.user_id)
     )
-    state["name"] = name
+    if state["name"] != name:
+        state["name"] = name
+        touch_leaderboard()   # names are shown on the leaderboard
 
     # Set initial deadline for module 0 (no deadline - free module)
     if state["module_index"] == 0 and not state.get("module_deadline"):
@@ -283,14 +389,12 @@ async def user_init(req: UserInitRequest):
     # Pulse (non-blocking: return cached if available)
     pulse = get_cached_pulse()
 
-    save_progress()
-    # Note: update_streak and claim_daily_bonus already call save_progress()
-    # Only save if name changed and neither function triggered a save
-    if not is_new_day and not got_bonus:
-        save_progress()
+    # name / last_online are not covered by the saves inside update_streak
+    # and claim_daily_bonus, so this user's record is written once more here
+    save_progress(req.user_id)
     return {
         "ok": True,
-        "state": state,
+        "state": state.to_dict(),
         "streak": streak,
         "is_new_day": is_new_day,
         "daily_bonus_xp": daily_xp if got_bonus else 0,
@@ -299,22 +403,24 @@ async def user_init(req: UserInitRequest):
     }
 
 
-def _state_safe(state: dict) -> dict:
-    """Return state without large binary fields."""
-    return {k: v for k, v in state.items() if k != "homework_photo"}
+def _state_safe(state: UserState) -> dict:
+    """Return state as a plain dict without the homework photo reference."""
+    data = state.to_dict()
+    data.pop("homework_photo", None)
+    return data
 
 
 @app.get("/api/user/{user_id}")
 async def get_user(user_id: int):
     """Return user state (excluding large binary fields)."""
-    state = get_user_state(user_id)
+    state = require_user(user_id)
     return _state_safe(state)
 
 
 @app.get("/api/user/{user_id}/full")
 async def get_user_full(user_id: int):
     """Full user state with computed deadline info."""
-    state = get_user_state(user_id)
+    state = require_user(user_id)
     result = _state_safe(state)
     result["deadline_info"] = build_deadline_info(state)
     result["next_level_xp"] = None
@@ -399,7 +505,7 @@ async def get_chart_png(lesson_key: str):
 @app.get("/api/quests/{user_id}")
 async def get_quests(user_id: int):
     """Return quests for user's current module with deadline info."""
-    state = get_user_state(user_id)
+    state = require_user(user_id)
     idx = state["module_index"]
     completed = set(state["completed_quests"])
     module_quests = [q for q in QUESTS if q["module_index"] == idx]
@@ -434,7 +540,7 @@ async def get_quests(user_id: int):
 @app.post("/api/quest/start")
 async def start_quest(req: QuestSubmitRequest):
     """Start a quest; for quizzes, shuffle and return questions."""
-    state = get_user_state(req.user_id)
+    state = require_user(req.user_id)
     if is_deadline_expired(state):
         return {
             "ok": False,
@@ -451,7 +557,7 @@ async def start_quest(req: QuestSubmitRequest):
         return {"ok": False, "error": "already_completed"}
 
     state["active_quest"] = req.quest_id
-    save_progress()
+    save_progress(req.user_id)
 
     response = {"ok": True, "quest": quest}
 
@@ -474,7 +580,7 @@ async def start_quest(req: QuestSubmitRequest):
             "total": len(quiz_list),
             "questions": shuffled,
         }
-        save_progress()
+        save_progress(req.user_id)
         response["quiz"] = {"questions": shuffled, "total": len(quiz_list)}
 
     return response
@@ -483,21 +589,25 @@ async def start_quest(req: QuestSubmitRequest):
 @app.post("/api/quiz/answer")
 async def quiz_answer(req: QuizAnswerRequest):
     """Process a quiz answer; finalize quiz if all questions answered."""
-    state = get_user_state(req.user_id)
-    qstate = state.get("quiz_state")
-    if not qstate:
-        raise HTTPException(status_code=400, detail="Квиз не активен")
+    require_user(req.user_id)
+    # One transaction: XP, badges, module advance and pet effect commit together
+    with transaction(req.user_id) as state:
+        qstate = state.get("quiz_state")
+        if not qstate:
+            raise HTTPException(status_code=400, detail="Квиз не активен")
+
+        if req.is_correct:
+            qstate["correct"] += 1
+        qstate["index"] = req.question_index + 1
+        state["quiz_state"] = qstate
+        save_progress(req.user_id)
 
-    if req.is_correct:
-        qstate["correct"] += 1
-    qstate["index"] = req.question_index + 1
-    state["quiz_state"] = qstate
-    save_progress()
+        total = qstate["total"]
+        current_index = qstate["index"]
 
-    total = qstate["total"]
-    current_index = qstate["index"]
+        if current_index < total:
+            return {"ok": True, "finished": False, "next_index": current_index}
 
-    if current_index >= total:
         score = qstate["correct"] / total if total > 0 else 0
         if score >= 0.7:
             quest_id = state.get("active_quest")
@@ -524,22 +634,18 @@ async def quiz_answer(req: QuizAnswerRequest):
                     except Exception as pe:
                         logger.warning(f"Pet effect error: {pe}")
 
-                save_progress()
-                # add_xp, award_badge, try_advance_module already save;
-                # no extra save_progress() needed here
                 return {
                     "ok": True, "finished": True, "passed": True,
                     "score": round(score * 100), "correct": qstate["correct"], "total": total,
                     "xp_earned": quest["xp_reward"],
                     "new_level": level, "leveled_up": leveled_up,
                     "module_advanced": advanced,
-                    "rank": get_user_state(req.user_id)["rank"],
+                    "rank": state["rank"],
                     "pet_effect": pet_effect,
                 }
         else:
             state["quiz_state"] = None
             state["active_quest"] = None
-            save_progress()
             return {
                 "ok": True, "finished": True, "passed": False,
                 "score": round(score * 100), "correct": qstate["correct"], "total": total,
@@ -549,18 +655,56 @@ async def quiz_answer(req: QuizAnswerRequest):
     return {"ok": True, "finished": False, "next_index": current_index}
 
 
-@app.post("/api/quest/submit")
-async def submit_task(req: QuestSubmitRequest):
-    """Submit homework task with optional photo; notify admins asynchronously."""
-    state = get_user_state(req.user_id)
-    if is_deadline_expired(state):
-        return {
-            "ok": False,
-            "error": "deadline_expired",
-            "penalty_amount": MODULE_PENALTIES.get(state["module_index"], 5),
-            "can_extend": state.get("deadline_extensions", 0) < MAX_EXTENSIONS,
-        }
+def _deadline_expired_reply(state) -> dict:
+    return {
+        "ok": False,
+        "error": "deadline_expired",
+        "penalty_amount": MODULE_PENALTIES.get(state["module_index"], 5),
+        "can_extend": state.get("deadline_extensions", 0) < MAX_EXTENSIONS,
+    }
 
+
+_notify_tasks: set = set()   # strong refs so pending notifications are not collected
+
+
+async def _notify_homework(user_id: int, quest_id: str, photo: Optional[dict],
+                           submission_id: int, user_name: Optional[str]) -> None:
+    """Notify reviewers of a new submission; runs as a background task."""
+    # The same picture sent again reuses the file_id Telegram gave it last time
+    tg_photo: bytes | str | None = review_queue.file_id_for(photo["sha256"]) if photo else None
+    if photo and not tg_photo:
+        # Admins get the downscaled preview rather than the original screenshot
+        try:
+            path, _mime = await _photo_file(photo, "preview")
+            tg_photo = await asyncio.get_running_loop().run_in_executor(None, path.read_bytes)
+        except (OSError, ValueError) as e:
+            logger.error("Фото ДЗ %d не прочитано: %s", user_id, e)
+
+    quest_obj   = next((q for q in QUESTS if q["id"] == quest_id), None)
+    quest_title = quest_obj["title"] if quest_obj else quest_id
+    user_name   = user_name or str(user_id)
+    admin_text  = (
+        f"📬 <b>Новое домашнее задание!</b>\n\n"
+        f"👤 Студент: <b>{_html.escape(str(user_name))}</b> (<code>{user_id}</code>)\n"
+        f"📝 Задание: <b>{_html.escape(str(quest_title))}</b>\n\n"
+        f"✅ Принять: <code>/approve {user_id} {quest_id}</code>\n"
+        f"🔄 Доработка: <code>/revision {user_id} {quest_id} комментарий</code>\n"
+        f"⛔ Отклонить: <code>/reject {user_id} {quest_id} причина</code>"
+    )
+    # Admin channel first (primary), then each admin; every chat exactly once
+    chat_ids = [cid for cid in (_get_admin_channel_id(),) if cid]
+    chat_ids += [aid for aid in sorted(_get_admin_ids()) if aid not in chat_ids]
+    _broadcast_homework(chat_ids, admin_text, tg_photo, user_id, quest_id, submission_id,
+                        photo["sha256"] if photo else None)
+
+
+async def _submit_homework(user_id: int, quest_id: str, photo: Optional[dict]) -> dict:
+    """Record a submission (photo already in the blob store) and queue it for review.
+
+    Admins are notified from a background task, so the reply never waits on
+    the preview render or on Telegram.
+    """
+    state = require_user(user_id)
     # Check if submitted within first 12 hours → "time is money" badge
     dl = state.get("module_deadline")
     if dl:
@@ -568,65 +712,23 @@ async def submit_task(req: QuestSubmitRequest):
             deadline_dt = datetime.fromisoformat(dl)
             hours_used = DEFAULT_DEADLINE_HOURS - (deadline_dt - datetime.utcnow()).total_seconds() / 3600
             if hours_used <= 12:
-                award_badge(req.user_id, "time_is_money")
+                award_badge(user_id, "time_is_money")
         except Exception:
             pass
 
-    state["active_quest"] = req.quest_id
+    state["active_quest"] = quest_id
     state["homework_status"] = "pending"
     state["homework_comment"] = ""
-    if req.photo:
-        # Cap at 1.5 MB decoded (~2 MB base64) to prevent JSON bloat
-        # Always keep the full data-URL prefix; truncate only excess payload
-        state["homework_photo"] = req.photo[:2_000_000]
-    save_progress()
-
-    # ── Notify all admins (non-blocking) ────────────────────────────────────
-    quest_obj   = next((q for q in QUESTS if q["id"] == req.quest_id), None)
-    quest_title = quest_obj["title"] if quest_obj else req.quest_id
-    user_name   = state.get("name") or str(req.user_id)
-    admin_text  = (
-        f"📬 <b>Новое домашнее задание!</b>\n\n"
-        f"👤 Студент: <b>{_html.escape(str(user_name))}</b> (<code>{req.user_id}</code>)\n"
-        f"📝 Задание: <b>{_html.escape(str(quest_title))}</b>\n\n"
-        f"✅ Принять: <code>/approve {req.user_id} {req.quest_id}</code>\n"
-        f"🔄 Доработка: <code>/revision {req.user_id} {req.quest_id} комментарий</code>\n"
-        f"⛔ Отклонить: <code>/reject {req.user_id} {req.quest_id} причина</code>"
-    )
-    # 1. Send to admin channel (primary)
-    channel_id = _get_admin_channel_id()
-    if channel_id:
-        try:
-            _send_hw_notification(channel_id, admin_text, req.photo, req.user_id, req.quest_id)
-        except Exception as e:
-            logger.error(f"Channel notify {channel_id}: {e}")
-
-    # 2. Send to individual admins (fallback / redundancy)
-    for aid in _get_admin_ids():
-        try:
-            _send_hw_notification(aid, admin_text, req.photo, req.user_id, req.quest_id)
-        except Exception as e:
-            logger.error(f"Admin notify {aid}: {e}")
-
-    def _notify_admins():
-        for aid in _get_admin_ids():
-            try:
-                if req.photo:
-                    photo_bytes = base64.b64decode(req.photo.split(",", 1)[-1])
-                    buf = io.BytesIO(photo_bytes)
-                    buf.name = "homework.jpg"
-                    try:
-                        telegram_bot.send_photo(aid, buf, caption=admin_text, parse_mode="HTML")
-                    except Exception as photo_err:
-                        logger.error("Admin photo %d: %s", aid, photo_err)
-                        telegram_bot.send_message(aid, admin_text, parse_mode="HTML")
-                else:
-                    telegram_bot.send_message(aid, admin_text, parse_mode="HTML")
-            except Exception as e:
-                logger.error("Admin notify %d: %s", aid, e)
+    if photo:
+        state["homework_photo"] = photo
+    save_progress(user_id)
+    # Every submission is its own queue entry; a resubmission no longer replaces the last
+    entry = review_queue.push(user_id, quest_id, photo)
 
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(None, _notify_admins)
+    # Admin notification (preview render + Telegram upload) runs after the reply
+    task = asyncio.create_task(_notify_homework(user_id, quest_id, photo, entry["id"], state.get("name")))
+    _notify_tasks.add(task)
+    task.add_done_callback(_notify_tasks.discard)
 
     return {
         "ok": True,
@@ -634,6 +736,68 @@ async def submit_task(req: QuestSubmitRequest):
     }
 
 
+@app.post("/api/quest/submit")
+async def submit_task(req: QuestSubmitRequest):
+    """Submit homework task with optional photo; notify admins asynchronously."""
+    state = require_user(req.user_id)
+    if is_deadline_expired(state):
+        return _deadline_expired_reply(state)
+
+    photo = None
+    if req.photo:
+        try:
+            photo_bytes, declared_mime = decode_data_url(req.photo)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректное фото")
+        if len(photo_bytes) > MAX_PHOTO_BYTES:
+            raise HTTPException(status_code=413, detail="Фото слишком большое (макс. 1.5 МБ)")
+        # Store the decoded image once by content hash; the record keeps only metadata
+        mime = sniff_image_mime(photo_bytes[:16]) or declared_mime or "application/octet-stream"
+        photo = put_blob(photo_bytes, mime)
+    return await _submit_homework(req.user_id, req.quest_id, photo)
+
+
+@app.post("/api/quest/submit/upload")
+async def submit_task_upload(request: Request):
+    """Submit homework as multipart/form-data: user_id, quest_id and a raw `photo` file.
+
+    The file is streamed into the blob store while it is read; oversize or
+    non-image uploads are refused as soon as that is known.
+    """
+    try:
+        fields, sink = await read_upload(request, "photo", MAX_PHOTO_BYTES)
+    except BlobTooLarge:
+        raise HTTPException(status_code=413, detail="Фото слишком большое (макс. 1.5 МБ)")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректное фото")
+    try:
+        user_id = int(fields.get("user_id", ""))
+        quest_id = fields.get("quest_id", "").strip()
+        if not quest_id:
+            raise ValueError("quest_id")
+    except ValueError:
+        if sink is not None:
+            sink.discard()
+        raise HTTPException(status_code=400, detail="Нужны user_id и quest_id")
+
+    state = peek_user_state(user_id)
+    if state is None:
+        if sink is not None:
+            sink.discard()
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    if is_deadline_expired(state):
+        if sink is not None:
+            sink.discard()
+        return _deadline_expired_reply(state)
+    photo = None
+    if sink is not None:
+        try:
+            photo = sink.commit()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректное фото")
+    return await _submit_homework(user_id, quest_id, photo)
+
+
 # ── DEADLINE PENALTY PAYMENT ──────────────────────────────────────────────────
 
 @app.post("/api/deadline/penalty")
@@ -644,7 +808,7 @@ async def pay_deadline_penalty(req: PenaltyPaymentRequest):
     payment_type: 'penalty' = first miss, 48h extension
                   'repurchase' = second miss, full module repurchase
     """
-    state = get_user_state(req.user_id)
+    state = require_user(req.user_id)
 
     if req.payment_type == "penalty":
         if state.get("deadline_extensions", 0) >= MAX_EXTENSIONS:
@@ -657,7 +821,7 @@ async def pay_deadline_penalty(req: PenaltyPaymentRequest):
 
         success = apply_penalty_extension(state)
         if success:
-            save_progress()
+            save_progress(req.user_id)
             new_dl = state.get("module_deadline")
             dl_info = build_deadline_info(state)
             return {
@@ -681,7 +845,7 @@ async def pay_deadline_penalty(req: PenaltyPaymentRequest):
         state["active_quest"] = None
         state["deadline_extensions"] = 0
         set_module_deadline(state, hours=DEFAULT_DEADLINE_HOURS)
-        save_progress()
+        save_progress(req.user_id)
         return {
             "ok": True,
             "message": "Модуль перекуплен. Новый дедлайн: 72 часа. Не повторяй ошибку.",
@@ -694,7 +858,7 @@ async def pay_deadline_penalty(req: PenaltyPaymentRequest):
 @app.get("/api/deadline/status/{user_id}")
 async def get_deadline_status(user_id: int):
     """Return deadline status with penalty/repurchase amounts."""
-    state = get_user_state(user_id)
+    state = require_user(user_id)
     info = build_deadline_info(state)
     info["module_index"] = state["module_index"]
     info["penalty_amount"] = MODULE_PENALTIES.get(state["module_index"], 5)
@@ -707,6 +871,7 @@ async def get_deadline_status(user_id: int):
 @app.post("/api/user/daily-bonus")
 async def daily_bonus_endpoint(user_id: int):
     """Claim daily login bonus XP."""
+    require_user(user_id)
     xp, got_bonus = claim_daily_bonus(user_id)
     streak, _ = update_streak(user_id)
     if got_bonus:
@@ -716,17 +881,54 @@ async def daily_bonus_endpoint(user_id: int):
 
 # ── LEADERBOARD & STATS ──────────────────────────────────────────────────────
 
+def _parse_leaderboard_cursor(cursor: str):
+    """Decode an "xp:user_id" cursor. Raises 400 if malformed."""
+    try:
+        xp, uid = cursor.split(":", 1)
+        return int(xp), int(uid)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+
 @app.get("/api/leaderboard")
-async def leaderboard(limit: int = Query(default=10, ge=1, le=50)):
-    """Return top users leaderboard."""
-    board = get_leaderboard(limit)
-    return {"leaderboard": board}
+async def leaderboard(
+    request: Request,
+    limit: int = Query(default=10, ge=1, le=50),
+    period: Optional[str] = None,
+    cursor: Optional[str] = None,
+):
+    """Return a leaderboard page: lifetime XP, or XP gained in a rolling week/month.
+
+    Pages are chained with `next_cursor`. The ETag is the leaderboard
+    version; a matching If-None-Match gets 304 without building the page.
+    """
+    if period is not None and period not in LEADERBOARD_PERIODS:
+        raise HTTPException(status_code=400, detail="Неизвестный период")
+    after = _parse_leaderboard_cursor(cursor) if cursor else None
+    etag = f'W/"lb-{leaderboard_version(period)}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    board = get_leaderboard(limit, period, after)
+    next_cursor = f'{board[-1]["xp"]}:{board[-1]["user_id"]}' if len(board) == limit else None
+    return JSONResponse(
+        {"leaderboard": board, "period": period or "all", "next_cursor": next_cursor},
+        headers={"ETag": etag},
+    )
+
+
+@app.get("/api/leaderboard/rank/{user_id}")
+async def leaderboard_rank(user_id: int, k: int = Query(default=2, ge=0, le=10)):
+    """Return the user's leaderboard position, percentile and ±k neighbours."""
+    info = get_user_rank(user_id, k)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return info
 
 
 @app.get("/api/stats/{user_id}")
 async def user_stats(user_id: int):
     """Return detailed user statistics with deadline and module progress."""
-    state = get_user_state(user_id)
+    state = require_user(user_id)
     idx = state["module_index"]
     module_title = MODULES[idx]["title"] if idx < len(MODULES) else "Завершено"
     dl_info = build_deadline_info(state)
@@ -749,122 +951,410 @@ async def user_stats(user_id: int):
 
 # ── ADMIN ─────────────────────────────────────────────────────────────────────
 
+def _approve_homework(user_id: int, quest: dict) -> dict:
+    """Approve one homework: award XP, badges, pet coins; maybe advance module.
+
+    Runs in its own transaction, or joins the caller's (bulk review).
+    Raises 404 for an unknown user rather than creating one. A quest that
+    was already completed is marked approved again but awards nothing.
+    """
+    require_user(user_id)
+    quest_id = quest["id"]
+    with transaction(user_id) as state:
+        state["active_quest"] = None
+        state["homework_status"] = "approved"
+        if quest_id in state["completed_quests"]:
+            return {"new_level": state["level"], "leveled_up": False,
+                    "module_advanced": False, "xp_earned": 0}
+        state["completed_quests"].append(quest_id)
+        level, leveled_up = add_xp(user_id, quest["xp_reward"])
+
+        # Award "disciplined" badge if homework submitted on time
+        if not is_deadline_expired(state) and state.get("module_deadline"):
+            award_badge(user_id, "disciplined")
+
+        advanced = False
+        if quest_id.endswith("_boss"):
+            advanced = try_advance_module(user_id)
+
+        # Check if all modules completed → CHM Legend badge
+        if state["module_index"] >= len(MODULES) - 1:
+            all_done = all(q["id"] in state["completed_quests"] for q in QUESTS)
+            if all_done:
+                award_badge(user_id, "chm_legend")
+
+        # Give pet coins for approved homework
+        try:
+            coin_reward = 50 if quest_id.endswith("_boss") else 30
+            add_pet_coins(user_id, coin_reward)
+        except Exception as ce:
+            logger.warning(f"Pet coins error on approval: {ce}")
+
+    return {"new_level": level, "leveled_up": leveled_up, "module_advanced": advanced,
+            "xp_earned": quest["xp_reward"]}
+
+
+def _reject_homework(user_id: int, status: str, comment: str) -> str:
+    """Mark homework rejected or sent back for revision. Returns the stored status."""
+    require_user(user_id)
+    with transaction(user_id) as state:
+        # "revision" = needs correction + resubmit; "rejected" = serious errors
+        state["homework_status"] = status if status in ("rejected", "revision") else "rejected"
+        state["homework_comment"] = comment
+    return state["homework_status"]
+
+
+def _approval_notice(quest: dict, result: dict) -> str:
+    """Student message for an approved homework (same wording as the bot)."""
+    notify = "✅ <b>Домашнее задание принято!</b>"
+    if result["xp_earned"]:
+        notify += f"\n+{result['xp_earned']} XP"
+    if result["leveled_up"]:
+        notify += f"\n⬆️ <b>Новый уровень: {result['new_level']}!</b>"
+    return notify
+
+
+def _rejection_notice(status: str, comment: str) -> str:
+    if status == "revision":
+        return (
+            f"🔄 <b>Нужна доработка домашки</b>\n\n"
+            f"Фидбек:\n<i>{_html.escape(comment)}</i>\n\n"
+            "Исправь разметку и отправь скрин снова."
+        )
+    return (
+        f"⛔ <b>Домашка не принята</b>\n\n"
+        f"Причина:\n<i>{_html.escape(comment)}</i>\n\n"
+        "Пересмотри уроки и сделай разметку заново."
+    )
+
+
+def _send_student_notices(notices: List[tuple]):
+    """Queue (chat_id, html_text) messages on the outbox."""
+    for chat_id, text in notices:
+        outbox.send_message(chat_id, text, parse_mode="HTML")
+
+
 @app.post("/api/admin/approve")
 async def admin_approve(req: AdminApproveRequest):
     """Admin: approve homework, award XP, and optionally advance module."""
     check_admin(req.admin_id)
-    state = get_user_state(req.user_id)
     quest = next((q for q in QUESTS if q["id"] == req.quest_id), None)
     if not quest:
         raise HTTPException(status_code=404, detail="Квест не найден")
-    if req.quest_id not in state["completed_quests"]:
-        state["completed_quests"].append(req.quest_id)
-    state["active_quest"] = None
-    state["homework_status"] = "approved"
-    level, leveled_up = add_xp(req.user_id, quest["xp_reward"])
-
-    # Award "disciplined" badge if homework submitted on time
-    if not is_deadline_expired(state) and state.get("module_deadline"):
-        award_badge(req.user_id, "disciplined")
-
-    advanced = False
-    if req.quest_id.endswith("_boss"):
-        advanced = try_advance_module(req.user_id)
-
-    # Check if all modules completed → CHM Legend badge
-    if state["module_index"] >= len(MODULES) - 1:
-        all_done = all(q["id"] in state["completed_quests"] for q in QUESTS)
-        if all_done:
-            award_badge(req.user_id, "chm_legend")
-
-    # Give pet coins for approved homework
-    try:
-        coin_reward = 50 if req.quest_id.endswith("_boss") else 30
-        add_pet_coins(req.user_id, coin_reward)
-    except Exception as ce:
-        logger.warning(f"Pet coins error on approval: {ce}")
-
-    save_progress()
-    return {"ok": True, "new_level": level, "leveled_up": leveled_up, "module_advanced": advanced}
+    result = _approve_homework(req.user_id, quest)
+    review_queue.resolve(req.user_id, req.quest_id)
+    return {"ok": True, **result}
 
 
 @app.post("/api/admin/reject")
 async def admin_reject(req: AdminRejectRequest):
     """Admin: reject or request revision for homework submission."""
     check_admin(req.admin_id)
-    state = get_user_state(req.user_id)
-    # "revision" = needs correction + resubmit; "rejected" = serious errors
-    state["homework_status"] = req.status if req.status in ("rejected", "revision") else "rejected"
-    state["homework_comment"] = req.comment or ""
-    save_progress()
-    return {"ok": True, "comment": req.comment, "status": state["homework_status"]}
+    status = _reject_homework(req.user_id, req.status, req.comment or "")
+    review_queue.resolve(req.user_id, req.quest_id)
+    return {"ok": True, "comment": req.comment, "status": status}
+
+
+@app.post("/api/admin/bulk")
+async def admin_bulk(req: AdminBulkRequest):
+    """Admin: apply a batch of approve/reject/revision decisions at once.
+
+    All decisions run in one transaction: either every one is applied and
+    committed together, or (on any error) none is. Students are notified
+    in the background after the commit.
+    """
+    check_admin(req.admin_id)
+    if not req.decisions:
+        raise HTTPException(status_code=400, detail="Пустой список решений")
+    if len(req.decisions) > MAX_BULK_DECISIONS:
+        raise HTTPException(status_code=400, detail=f"Не больше {MAX_BULK_DECISIONS} решений за раз")
+    quests = {q["id"]: q for q in QUESTS}
+    seen = set()
+    for i, d in enumerate(req.decisions):
+        if d.action not in ("approve", "reject", "revision"):
+            raise HTTPException(status_code=400, detail=f"Решение {i}: неизвестное действие")
+        if d.action == "approve" and d.quest_id not in quests:
+            raise HTTPException(status_code=404, detail=f"Решение {i}: квест не найден")
+        if peek_user_state(d.user_id) is None:
+            raise HTTPException(status_code=404, detail=f"Решение {i}: пользователь не найден")
+        # One decision per submission: a repeated pair would award or notify twice
+        if (d.user_id, d.quest_id) in seen:
+            raise HTTPException(status_code=400, detail=f"Решение {i}: повторное решение по заданию")
+        seen.add((d.user_id, d.quest_id))
+
+    results, notices = [], []
+    # Nested transactions join this outer one, so the whole batch commits once
+    with transaction(req.decisions[0].user_id):
+        for d in req.decisions:
+            if d.action == "approve":
+                quest = quests[d.quest_id]
+                result = _approve_homework(d.user_id, quest)
+                notices.append((d.user_id, _approval_notice(quest, result)))
+            else:
+                default = "Нужно доработать." if d.action == "revision" else "Не принято."
+                comment = d.comment or default
+                result = {"status": _reject_homework(d.user_id, d.action, comment)}
+                notices.append((d.user_id, _rejection_notice(result["status"], comment)))
+            results.append({"user_id": d.user_id, "quest_id": d.quest_id, "action": d.action, **result})
+
+    for d in req.decisions:
+        review_queue.resolve(d.user_id, d.quest_id)
+    _send_student_notices(notices)
+    return {"ok": True, "applied": len(results), "results": results}
 
 
 @app.post("/api/admin/extend")
 async def admin_extend(req: ExtendRequest):
     """Admin: extend user deadline by N days (does not count against MAX_EXTENSIONS)."""
     check_admin(req.admin_id)
-    state = get_user_state(req.user_id)
-    now = datetime.utcnow()
-    dl = state.get("module_deadline")
-    try:
-        base = datetime.fromisoformat(dl) if dl else now
-    except Exception:
-        base = now
-    new_dl = base + timedelta(days=req.days)
-    state["module_deadline"] = new_dl.isoformat()
+    state = require_user(req.user_id)
     # Admin extension doesn't count against MAX_EXTENSIONS
-    save_progress()
+    new_dl = extend_deadline(state, req.days)
+    save_progress(req.user_id)
     return {"ok": True, "new_deadline": new_dl.date().isoformat()}
 
 
+def _photo_links(photo: dict) -> dict:
+    """Thumbnail for list rows, preview for the opened submission (client adds admin_id).
+
+    Links name the blob itself, so a later resubmission never changes what
+    an older queue entry shows.
+    """
+    base = f"/api/admin/photo/{photo['sha256']}"
+    return {"photo_thumb": f"{base}?size=thumb", "photo_preview": f"{base}?size=preview"}
+
+
+def _admin_user_row(uid: int, st) -> dict:
+    hours_left = get_deadline_hours_remaining(st)
+    return {
+        "user_id": uid,
+        "name": st.get("name", str(uid)),
+        "level": st.get("level", 1), "xp": st.get("xp", 0),
+        "rank": st.get("rank", "Наблюдатель рынка"),
+        "module_index": st.get("module_index", 0),
+        "homework_status": st.get("homework_status", "idle"),
+        "homework_comment": st.get("homework_comment", ""),
+        "has_photo": bool(st.get("homework_photo")),
+        **(_photo_links(st.homework_photo) if st.get("homework_photo") else {}),
+        "active_quest": st.get("active_quest"),
+        "streak": st.get("streak", 0),
+        "badges": st.get("badges", []),
+        "is_expired": is_deadline_expired(st),
+        # inf (no deadline) is not valid JSON
+        "hours_remaining": round(hours_left, 1) if hours_left != float("inf") else None,
+    }
+
+
 @app.get("/api/admin/users")
-async def admin_users(admin_id: int):
-    """Admin: list all users with progress, deadline, and homework status."""
+async def admin_users(
+    admin_id: int,
+    homework_status: Optional[str] = None,
+    module_index: Optional[int] = None,
+    expired: Optional[bool] = None,
+    has_photo: Optional[bool] = None,
+    sort: str = "xp",
+    order: str = Query(default="desc", pattern="^(asc|desc)$"),
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=200),
+):
+    """Admin: one page of users with progress, deadline, and homework status.
+
+    Filters and sorting are served from secondary indexes; only the rows
+    on the requested page are built.
+    """
     check_admin(admin_id)
-    result = [
-        {
-            "user_id": uid,
-            "name": st.get("name", str(uid)),
-            "level": st.get("level", 1), "xp": st.get("xp", 0),
-            "rank": st.get("rank", "Наблюдатель рынка"),
-            "module_index": st.get("module_index", 0),
-            "homework_status": st.get("homework_status", "idle"),
-            "homework_comment": st.get("homework_comment", ""),
-            "has_photo": bool(st.get("homework_photo")),
-            "active_quest": st.get("active_quest"),
-            "streak": st.get("streak", 0),
-            "badges": st.get("badges", []),
-            "is_expired": is_deadline_expired(st),
-            "hours_remaining": round(get_deadline_hours_remaining(st), 1),
-        }
-        for uid, st in user_progress.items()
-    ]
-    return {"users": result}
+    if sort not in ADMIN_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Неизвестное поле сортировки")
+    total, page = query_users(homework_status, module_index, expired, has_photo,
+                              sort=sort, descending=order == "desc",
+                              offset=offset, limit=limit)
+    return {
+        "users": [_admin_user_row(uid, user_progress[uid]) for uid in page],
+        "total": total, "offset": offset, "limit": limit,
+    }
+
+
+@app.get("/api/admin/summary")
+async def admin_dashboard_summary(admin_id: int):
+    """Admin: dashboard counters (modules, homework, streaks, XP, quiz accuracy).
+
+    Served from aggregates maintained on every commit, so the cost does not
+    grow with the number of students.
+    """
+    check_admin(admin_id)
+    return admin_summary()
+
+
+EXPORT_CHUNK = 500   # rows encoded per yield; the loop is released between chunks
+
+
+def _export_cell(value):
+    """CSV cell: lists/dicts as JSON, None as empty."""
+    if value is None:
+        return ""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return value
+
+
+async def _export_stream(fmt: str, columns: tuple):
+    # Only ids are copied up front; each row is encoded when its chunk is sent
+    ids = list(user_progress)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == "csv":
+        writer.writerow(columns)
+    for start in range(0, len(ids), EXPORT_CHUNK):
+        for uid in ids[start:start + EXPORT_CHUNK]:
+            st = peek_user_state(uid)
+            if st is None:   # reset/removed mid-export
+                continue
+            row = export_row(uid, st, columns)
+            if fmt == "csv":
+                writer.writerow([_export_cell(v) for v in row.values()])
+            else:
+                buf.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if buf.tell():
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        await asyncio.sleep(0)
+    if buf.tell():
+        yield buf.getvalue()
+
+
+@app.get("/api/admin/export")
+async def admin_export(
+    admin_id: int,
+    format: str = Query(default="ndjson", pattern="^(ndjson|csv)$"),
+    columns: Optional[str] = None,
+):
+    """Admin: stream every user record as NDJSON or CSV.
+
+    `columns` is a comma-separated projection (e.g. "user_id,name,xp,dna.quiz_correct").
+    Homework photos and other blob references are never exported.
+    """
+    check_admin(admin_id)
+    if columns:
+        cols = tuple(c.strip() for c in columns.split(",") if c.strip())
+        unknown = [c for c in cols if c not in EXPORT_COLUMNS]
+        if unknown or not cols:
+            raise HTTPException(status_code=400, detail=f"Неизвестные колонки: {', '.join(unknown)}")
+    else:
+        cols = EXPORT_DEFAULT_COLUMNS
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _export_stream(format, cols),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'},
+    )
+
+
+@app.get("/api/admin/queue")
+async def admin_queue(
+    admin_id: int,
+    after: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=200),
+):
+    """Admin: pending homework submissions, oldest first.
+
+    Pages are chained by passing the last entry's id as `after`.
+    """
+    check_admin(admin_id)
+    items = review_queue.page(after, limit)
+    for item in items:
+        st = peek_user_state(item["user_id"])
+        item["name"] = (st.name if st is not None else None) or str(item["user_id"])
+        if item.get("photo"):
+            item.update(_photo_links(item["photo"]))
+    return {
+        "items": items,
+        "total": len(review_queue),
+        "next_cursor": items[-1]["id"] if len(items) == limit else None,
+    }
+
+
+@app.get("/api/admin/outbox")
+async def admin_outbox(admin_id: int):
+    """Admin: outbound Telegram queue depth, oldest wait and delivery counters."""
+    check_admin(admin_id)
+    return outbox.stats()
 
 
 @app.get("/api/admin/homework_photo/{user_id}")
-async def get_homework_photo(user_id: int, admin_id: int):
-    """Return the homework photo submitted by a user (admin only)."""
+async def get_homework_photo(
+    user_id: int,
+    admin_id: int,
+    size: str = Query(default="full", pattern="^(full|preview|thumb)$"),
+):
+    """Stream a user's homework photo from the blob store (admin only).
+
+    size=thumb for lists, size=preview for the review view, size=full for
+    the original upload. Renditions fall back to the original if missing.
+    """
     check_admin(admin_id)
-    st = get_user_state(user_id)
-    photo = st.get("homework_photo")
+    st = peek_user_state(user_id)
+    photo = st.get("homework_photo") if st is not None else None
     if not photo:
         raise HTTPException(status_code=404, detail="Фото не найдено")
-    return {"photo": photo}
+    try:
+        path, mime = await _photo_file(photo, size)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Фото не найдено")
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Фото не найдено")
+    return FileResponse(str(path), media_type=mime)
+
+
+@app.get("/api/admin/photo/{sha256}")
+async def get_blob_photo(
+    sha256: str,
+    admin_id: int,
+    size: str = Query(default="full", pattern="^(full|preview|thumb)$"),
+):
+    """Stream one stored homework photo by content hash (admin only).
+
+    Queue entries link here, so each submission shows its own picture even
+    after the student has resubmitted.
+    """
+    check_admin(admin_id)
+    try:
+        original = blob_path(sha256)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Фото не найдено")
+    if not original.exists():
+        raise HTTPException(status_code=404, detail="Фото не найдено")
+    with open(original, "rb") as f:
+        mime = sniff_image_mime(f.read(16)) or "application/octet-stream"
+    path, mime = await _photo_file({"sha256": sha256, "mime": mime}, size)
+    return FileResponse(str(path), media_type=mime)
 
 
 # ── WEBHOOK ───────────────────────────────────────────────────────────────────
 
+# Webhook updates: persisted, acknowledged, then handled by per-chat ordered workers
+update_inbox = UpdateInbox(INBOX_DIR, process_update)
+
+
 @app.post("/webhook")
 async def webhook(request: Request):
-    """Process incoming Telegram webhook updates."""
+    """Accept a Telegram update: persist it to the inbox and acknowledge at once.
+
+    Handling happens on the inbox workers; redelivered update_ids are ignored.
+    """
     try:
         data = await request.json()
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, process_update, data)
+        update_id = int(data["update_id"])
     except Exception as e:
+        # Malformed: redelivery would not fix it, so acknowledge and drop
         logger.error(f"Webhook error: {e}")
+        return {"ok": True}
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, update_inbox.accept, data)
+    except Exception as e:
+        # Not on disk, so not acknowledged: Telegram redelivers it
+        logger.error("Апдейт %d не сохранён во входящие: %s", update_id, e)
+        raise HTTPException(status_code=503, detail="Апдейт не сохранён")
     return {"ok": True}
 
 
@@ -900,6 +1390,7 @@ async def get_webhook_info(admin_id: int):
             "pending_update_count": info.pending_update_count,
             "last_error_date": info.last_error_date,
             "last_error_message": info.last_error_message,
+            "inbox_pending": len(update_inbox),
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -918,30 +1409,30 @@ async def market_pulse_endpoint():
 @app.get("/api/oracle/daily")
 async def oracle_daily(user_id: int):
     oracle = await generate_oracle()
-    # Mark that user viewed the oracle today
-    state = get_user_state(user_id)
-    pet   = state.setdefault("pet", {})
-    pet["oracle_viewed_today"] = True
-    save_progress()
+    # Mark that user viewed the oracle today (known users only)
+    state = peek_user_state(user_id)
+    if state is not None:
+        state.pet.oracle_viewed_today = True
+        save_progress(user_id)
     return oracle
 
 
 @app.post("/api/oracle/answer")
 async def oracle_answer(req: OracleAnswerRequest):
-    state = get_user_state(req.user_id)
-    pet   = state.setdefault("pet", {})
-    if req.correct:
-        pet["oracle_correct"] = pet.get("oracle_correct", 0) + 1
-        add_pet_coins(req.user_id, 25)
-        pet["happiness"] = min(100, pet.get("happiness", 0) + 15)
-        update_trader_dna(req.user_id, "prediction_correct")
-    else:
-        update_trader_dna(req.user_id, "prediction_wrong")
-    save_progress()
-    evo = check_and_update_evolution(req.user_id)
+    require_user(req.user_id)
+    with transaction(req.user_id) as state:
+        pet = state.pet
+        if req.correct:
+            pet.oracle_correct += 1
+            add_pet_coins(req.user_id, 25)
+            pet.happiness = min(100, pet.happiness + 15)
+            update_trader_dna(req.user_id, "prediction_correct")
+        else:
+            update_trader_dna(req.user_id, "prediction_wrong")
+        evo = check_and_update_evolution(req.user_id)
     return {
         "ok":            True,
-        "oracle_correct":pet.get("oracle_correct", 0),
+        "oracle_correct":pet.oracle_correct,
         "coins_earned":  25 if req.correct else 0,
         "evolution":     evo,
     }
@@ -951,11 +1442,11 @@ async def oracle_answer(req: OracleAnswerRequest):
 
 @app.get("/api/pet/dream/{user_id}")
 async def pet_dream_get(user_id: int):
-    state = get_user_state(user_id)
+    state = require_user(user_id)
     dream = await generate_dream(user_id, state)
     # Update last_online AFTER dream check (dream check uses the old value)
     state["last_online"] = datetime.utcnow().isoformat()
-    save_progress()
+    save_progress(user_id)
     if not dream:
         return {"ok": True, "has_dream": False}
     return dream
@@ -963,25 +1454,23 @@ async def pet_dream_get(user_id: int):
 
 @app.post("/api/pet/dream/answer")
 async def pet_dream_answer(req: DreamAnswerRequest):
-    state = get_user_state(req.user_id)
-    pet   = state.setdefault("pet", {})
-    pet["last_dream_shown"] = datetime.utcnow().isoformat()
-
+    require_user(req.user_id)
     coins = 0
     xp_   = 0
-    if req.correct:
-        coins = 20
-        xp_   = 12
-        add_pet_coins(req.user_id, coins)
-        pet["happiness"] = min(100, pet.get("happiness", 0) + 20)
-        pet["hunger"]    = min(100, pet.get("hunger", 0) + 10)
-        if req.concept:
-            update_trader_dna(req.user_id, "quiz_correct")
-    else:
-        if req.concept:
-            update_trader_dna(req.user_id, "quiz_wrong")
-
-    save_progress()
+    with transaction(req.user_id) as state:
+        pet = state.pet
+        pet.last_dream_shown = datetime.utcnow().isoformat()
+        if req.correct:
+            coins = 20
+            xp_   = 12
+            add_pet_coins(req.user_id, coins)
+            pet.happiness = min(100, pet.happiness + 20)
+            pet.hunger    = min(100, pet.hunger + 10)
+            if req.concept:
+                update_trader_dna(req.user_id, "quiz_correct")
+        else:
+            if req.concept:
+                update_trader_dna(req.user_id, "quiz_wrong")
     return {"ok": True, "correct": req.correct, "coins_earned": coins, "xp_earned": xp_}
 
 
@@ -989,6 +1478,7 @@ async def pet_dream_answer(req: DreamAnswerRequest):
 
 @app.get("/api/pet/evolution/{user_id}")
 async def pet_evolution(user_id: int):
+    require_user(user_id)
     evo = check_and_update_evolution(user_id)
     return {"ok": True, **evo, "all_stages": EVOLUTION_STAGES}
 
@@ -997,6 +1487,7 @@ async def pet_evolution(user_id: int):
 
 @app.get("/api/user/dna/{user_id}")
 async def user_dna(user_id: int):
+    require_user(user_id)
     return {"ok": True, **get_trader_dna(user_id)}
 
 
@@ -1018,7 +1509,9 @@ _QUIZ_REF_TO_LESSON: Dict[str, str] = {
 
 @app.get("/api/pet/{user_id}")
 async def get_pet(user_id: int):
-    pet = get_pet_state(user_id)
+    pet = peek_pet_state(user_id)
+    if pet is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
     return {
         "ok": True,
         "hunger":           round(pet["hunger"]),
@@ -1036,6 +1529,7 @@ async def get_pet(user_id: int):
 
 @app.post("/api/pet/tap")
 async def pet_tap(req: PetTapRequest):
+    require_user(req.user_id)
     result = pet_register_tap(req.user_id)
     return {"ok": True, **result}
 
@@ -0,0 +1,299 @@
+"""
+outbox.py — Rate-limited outbound queue for Telegram messages.
+
+Handlers enqueue a Bot API call (send_message, send_photo, ...) and return
+at once. A small pool of worker threads makes the calls, within Telegram's
+limits:
+  - global: TG_GLOBAL_RATE messages per second (default 25, limit ~30)
+  - per chat: 1 message per second to a user, 20 per minute to a group or
+    channel (negative chat id), each with a small burst allowance
+
+Both limits are token buckets. Pending calls are kept in a FIFO per chat,
+and a heap orders chats by when they may send next. A chat is owned by at
+most one worker at a time, so messages to one chat keep their order.
+
+A 429 response puts the call back at the head of its chat's queue and
+pauses that chat for the `retry_after` Telegram sends back. Network
+errors and 5xx are retried with exponential backoff. Other API errors
+(blocked bot, bad request) fail at once. stats() reports queue depth and
+counters for /api/admin/outbox.
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "4"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+PRIVATE_CHAT_RATE = 1.0          # messages/second to one user
+GROUP_CHAT_RATE = 20 / 60        # messages/second to one group or channel
+CHAT_BURST = 3
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECS = 1.0
+BACKOFF_MAX_SECS = 60.0
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `capacity`."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def wait(self, now: float) -> float:
+        """Seconds until a token is available (0.0 if one is now)."""
+        if now < self.stamp:   # blocked by block()
+            return self.stamp - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return now >= self.stamp and self.tokens >= self.capacity
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float) -> None:
+        """Hold the bucket until `until`, then allow one call (429 retry_after)."""
+        self.tokens = 1.0
+        self.stamp = max(self.stamp, until)
+
+
+class _Job:
+    __slots__ = ("chat_id", "method", "args", "kwargs", "on_done", "on_error", "attempts", "queued_at")
+
+    def __init__(self, chat_id, method, args, kwargs, on_done, on_error):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.on_error = on_error
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    """retry_after seconds of a Telegram 429, else None."""
+    if getattr(exc, "error_code", None) != 429:
+        return None
+    params = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+def _is_transient(exc: Exception) -> bool:
+    """Network failures and Telegram 5xx are worth retrying; other API errors are not."""
+    code = getattr(exc, "error_code", None)
+    if code is None:
+        return not isinstance(exc, (TypeError, ValueError))
+    return code >= 500
+
+
+class Outbox:
+    """Queue of Bot API calls drained by a rate-limited worker pool."""
+
+    def __init__(self, bot: Any, workers: int = TG_SEND_WORKERS, global_rate: float = TG_GLOBAL_RATE):
+        self.bot = bot
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._chats: Dict[int, Deque[_Job]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._ready: List[Tuple[float, int, int]] = []   # (not_before, seq, chat_id)
+        self._scheduled: set = set()                     # chats in _ready or owned by a worker
+        self._seq = itertools.count()
+        self._global = TokenBucket(global_rate, global_rate, time.monotonic())
+        self._threads: List[threading.Thread] = []
+        self._running = False
+        self._depth = 0
+        self._in_flight = 0
+        self.counters = {"sent": 0, "failed": 0, "retried": 0, "rate_limited": 0}
+
+    # ── lifecycle ────────────────────────────────────────────────────────────
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._threads = [
+                threading.Thread(target=self._worker, name=f"tg-outbox-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self, drain_secs: float = 5.0) -> None:
+        """Give queued calls up to `drain_secs` to go out, then stop the workers."""
+        deadline = time.monotonic() + drain_secs
+        with self._cond:
+            while (self._depth or self._in_flight) and self._running:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    logger.warning("Исходящая очередь Telegram: не отправлено %d сообщений", self._depth)
+                    break
+                self._cond.wait(min(left, 0.5))
+            self._running = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=1)
+        self._threads = []
+
+    # ── public API ───────────────────────────────────────────────────────────
+
+    def send(self, method: str, chat_id: int, *args: Any,
+             on_done: Optional[Callable[[Any], None]] = None,
+             on_error: Optional[Callable[[Exception], None]] = None,
+             **kwargs: Any) -> None:
+        """Queue bot.<method>(chat_id, *args, **kwargs).
+
+        on_done(result) / on_error(exc) run on the worker thread once the
+        call has succeeded or has finally failed.
+        """
+        job = _Job(chat_id, method, args, kwargs, on_done, on_error)
+        with self._cond:
+            self._chats.setdefault(chat_id, deque()).append(job)
+            self._depth += 1
+            if chat_id not in self._scheduled:
+                self._schedule(chat_id, 0.0)
+            self._cond.notify()
+        if not self._running:
+            self.start()
+
+    def send_message(self, chat_id: int, text: str, **kwargs: Any) -> None:
+        self.send("send_message", chat_id, text, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and delivery counters."""
+        with self._cond:
+            oldest = min((q[0].queued_at for q in self._chats.values() if q), default=None)
+            return {
+                "depth": self._depth,
+                "chats_waiting": sum(1 for q in self._chats.values() if q),
+                "in_flight": self._in_flight,
+                "oldest_wait_secs": round(time.monotonic() - oldest, 1) if oldest is not None else 0.0,
+                "workers": len(self._threads),
+                **self.counters,
+            }
+
+    # ── scheduling (callers hold self._cond) ─────────────────────────────────
+
+    def _schedule(self, chat_id: int, not_before: float) -> None:
+        self._scheduled.add(chat_id)
+        heapq.heappush(self._ready, (not_before, next(self._seq), chat_id))
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10_000:
+                # Drop idle chats; a refilled bucket holds no state worth keeping
+                self._buckets = {cid: b for cid, b in self._buckets.items()
+                                 if cid in self._scheduled or not b.full(now)}
+            rate = GROUP_CHAT_RATE if chat_id < 0 else PRIVATE_CHAT_RATE
+            bucket = self._buckets[chat_id] = TokenBucket(rate, CHAT_BURST, now)
+        return bucket
+
+    def _next_job(self) -> Optional[_Job]:
+        """Block until some chat may send; take its head job and the tokens."""
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                not_before, _seq, chat_id = self._ready[0]
+                if not_before > now:
+                    self._cond.wait(not_before - now)
+                    continue
+                heapq.heappop(self._ready)
+                queue = self._chats.get(chat_id)
+                if not queue:
+                    self._scheduled.discard(chat_id)
+                    self._chats.pop(chat_id, None)
+                    continue
+                bucket = self._bucket(chat_id, now)
+                wait = max(bucket.wait(now), self._global.wait(now))
+                if wait > 0:
+                    self._schedule(chat_id, now + wait)
+                    continue
+                bucket.take(now)
+                self._global.take(now)
+                self._depth -= 1
+                self._in_flight += 1
+                return queue.popleft()   # chat stays in _scheduled: owned by this worker
+            return None
+
+    def _finish(self, job: _Job, retry_at: Optional[float] = None) -> None:
+        """Release the chat; put `job` back at its head if it is to be retried."""
+        with self._cond:
+            self._in_flight -= 1
+            queue = self._chats.setdefault(job.chat_id, deque())
+            if retry_at is not None:
+                queue.appendleft(job)
+                self._depth += 1
+            if queue:
+                self._schedule(job.chat_id, retry_at or 0.0)
+            else:
+                self._scheduled.discard(job.chat_id)
+                self._chats.pop(job.chat_id, None)
+            self._cond.notify_all()
+
+    # ── worker ───────────────────────────────────────────────────────────────
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job.attempts += 1
+            try:
+                result = getattr(self.bot, job.method)(job.chat_id, *job.args, **job.kwargs)
+            except Exception as e:
+                delay = _retry_after(e)
+                if delay is not None:
+                    with self._cond:
+                        self.counters["rate_limited"] += 1
+                        self._bucket(job.chat_id, time.monotonic()).block(time.monotonic() + delay)
+                    logger.warning("Telegram 429 для %s: повтор через %.0f с", job.chat_id, delay)
+                elif _is_transient(e) and job.attempts < MAX_ATTEMPTS:
+                    delay = min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2 ** (job.attempts - 1))
+                    with self._cond:
+                        self.counters["retried"] += 1
+                else:
+                    with self._cond:
+                        self.counters["failed"] += 1
+                    logger.warning("Не удалось отправить %s в %s: %s", job.method, job.chat_id, e)
+                    self._finish(job)
+                    self._callback(job.on_error, e)
+                    continue
+                self._finish(job, retry_at=time.monotonic() + delay)
+                continue
+            with self._cond:
+                self.counters["sent"] += 1
+            self._finish(job)
+            self._callback(job.on_done, result)
+
+    @staticmethod
+    def _callback(fn: Optional[Callable[[Any], None]], arg: Any) -> None:
+        if fn is None:
+            return
+        try:
+            fn(arg)
+        except Exception as e:
+            logger.error("Ошибка в обработчике исходящего сообщения: %s", e)
@@ -1,18 +1,81 @@
-import json
+import asyncio
+import copy
+import heapq
+import math
 import logging
 import os
-import fcntl
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import islice
 from pathlib import Path
 from datetime import datetime, timedelta, date
-from typing import Dict, Any, List, Tuple
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
+
+from blob_store import decode_data_url, put_blob, sniff_image_mime
+from progress_store import (
+    Journal, ProgressWriter, SqliteStore, encode_record,
+    migrate_json_to_sqlite, read_snapshot,
+)
+from user_state import SCHEMA_VERSION, DnaStats, PetState, UserState
+from user_index import UserIndex
+from xp_index import XpIndex, select_top
+from reminders import DEADLINE, ReminderSchedule
 
 logger = logging.getLogger(__name__)
 
 _data_dir = Path(os.getenv("DATA_DIR", "."))
 _data_dir.mkdir(parents=True, exist_ok=True)
 PROGRESS_FILE = _data_dir / "progress_smc.json"
+JOURNAL_FILE  = _data_dir / "progress_smc.journal"
+SQLITE_FILE   = _data_dir / "progress_smc.db"
+
+# Storage backend: "json" (snapshot file, optionally journaled) or "sqlite"
+PROGRESS_BACKEND = os.getenv("PROGRESS_BACKEND", "json").strip().lower()
+SQLITE_MODE      = PROGRESS_BACKEND == "sqlite"
+
+# Journal mode: saves append per-user records instead of rewriting the whole file
+JOURNAL_MODE             = not SQLITE_MODE and os.getenv("PROGRESS_JOURNAL", "0") == "1"
+JOURNAL_COMPACT_RECORDS  = int(os.getenv("PROGRESS_JOURNAL_COMPACT_RECORDS", "5000"))
+JOURNAL_COMPACT_INTERVAL = int(os.getenv("PROGRESS_JOURNAL_COMPACT_SECS", "600"))
+
+_journal = Journal(JOURNAL_FILE)
+_sqlite: Optional[SqliteStore] = SqliteStore(SQLITE_FILE) if SQLITE_MODE else None
+_writer = ProgressWriter(
+    PROGRESS_FILE,
+    journal=_journal if JOURNAL_MODE else None,
+    sqlite=_sqlite,
+    compact_records=JOURNAL_COMPACT_RECORDS,
+)
+
+# Rolling leaderboard periods (days, today included) and how often their badges are awarded
+LEADERBOARD_PERIODS  = {"week": 7, "month": 30}
+XP_HISTORY_DAYS      = max(LEADERBOARD_PERIODS.values())
+PERIOD_BADGE_INTERVAL = int(os.getenv("PERIOD_BADGE_INTERVAL_SECS", "3600"))
+
+# Write-behind: saves inside this window are coalesced into one commit
+SAVE_WINDOW_SECS = int(os.getenv("PROGRESS_SAVE_WINDOW_MS", "250")) / 1000
 
 _save_scheduled = False
+_dirty_users: set = set()
+_full_save_pending = False
+_dirty_lock = threading.Lock()
+_flush_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class _Transaction:
+    """Open unit of work: entry snapshots for rollback plus users saved inside."""
+
+    __slots__ = ("snapshots", "dirty", "full")
+
+    def __init__(self):
+        self.snapshots: Dict[int, Optional[Dict[str, Any]]] = {}
+        self.dirty: set = set()
+        self.full = False
+
+
+# Per-task (contextvars), so concurrent requests never share a transaction
+_current_tx: ContextVar[Optional[_Transaction]] = ContextVar("progress_tx", default=None)
 
 # ── CONSTANTS ────────────────────────────────────────────────────────────────
 DEFAULT_DEADLINE_HOURS = 72   # 72 hours per module (the market doesn't wait)
@@ -120,80 +183,304 @@ BADGE_DEFS = {
                          "desc": "Выдан преподавателем за скорость"},
 }
 
-user_progress: Dict[int, Dict[str, Any]] = {}
+user_progress: Dict[int, UserState] = {}
+
+# Leaderboard order, kept in step with every XP change (see _reindex_xp)
+xp_index = XpIndex()
+
+# Admin lookups (status/module/photo/deadline), synced on every commit
+user_index = UserIndex()
+
+# Upcoming deadline/inactivity reminders, synced on every commit
+reminder_schedule = ReminderSchedule()
 
 
 # ── LOAD / SAVE ───────────────────────────────────────────────────────────────
 
 def load_progress():
-    """Load user progress from JSON file with file locking."""
-    global user_progress
-    if PROGRESS_FILE.exists():
-        try:
-            with open(PROGRESS_FILE, "r", encoding="utf-8") as f:
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
-                try:
-                    data = json.load(f)
-                finally:
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            user_progress = {int(k): v for k, v in data.items()}
-            logger.info("Прогресс загружен: %d пользователей", len(user_progress))
-        except Exception as e:
-            logger.error("Ошибка загрузки прогресса: %s", e)
-            user_progress = {}
-    else:
-        logger.info("Файл прогресса не найден, начинаем с нуля")
+    """Load user progress: snapshot file, then journal replay in journal mode.
+
+    In SQLite mode rows are read from progress_smc.db; an empty database is
+    first filled once from an existing JSON snapshot/journal.
+    Records older than SCHEMA_VERSION are upgraded once here and written
+    back, so the accessors below never need back-compat defaulting.
+    Updates `user_progress` in place so modules that imported it by name
+    keep seeing the live dict.
+    """
+    try:
+        if SQLITE_MODE:
+            if _sqlite.count() == 0 and (PROGRESS_FILE.exists() or JOURNAL_FILE.exists()):
+                migrated = migrate_json_to_sqlite(PROGRESS_FILE, JOURNAL_FILE, _sqlite)
+                logger.info("Прогресс перенесён из JSON в SQLite: %d пользователей", migrated)
+            data = _sqlite.load_all()
+            replayed = 0
+        else:
+            data = read_snapshot(PROGRESS_FILE)
+            replayed = _journal.replay(data) if JOURNAL_MODE else 0
+        upgraded = sum(_upgrade_record(st) for st in data.values())
+        user_progress.clear()
+        user_progress.update((uid, UserState.from_dict(st)) for uid, st in data.items())
+        _writer.seed(encode_record(uid, st.to_dict()) for uid, st in user_progress.items())
+        xp_index.rebuild((uid, st.xp) for uid, st in user_progress.items())
+        user_index.rebuild(user_progress.items())
+        reminder_schedule.rebuild(user_progress.items())
+        _invalidate_period_totals()
+        if upgraded:
+            logger.info("Записи обновлены до схемы v%d: %d", SCHEMA_VERSION, upgraded)
+            save_progress()
+        if data or replayed:
+            logger.info("Прогресс загружен: %d пользователей (журнал: %d записей)",
+                        len(user_progress), replayed)
+        else:
+            logger.info("Файл прогресса не найден, начинаем с нуля")
+    except Exception as e:
+        logger.error("Ошибка загрузки прогресса: %s", e)
+        user_progress.clear()
+        xp_index.rebuild(())
+        user_index.rebuild(())
+        reminder_schedule.rebuild(())
+
+
+# ── SCHEMA MIGRATIONS ─────────────────────────────────────────────────────────
+
+def _migrate_photo_to_blob(state: Dict[str, Any]) -> None:
+    """v1: move an inline base64 homework_photo into the blob store."""
+    photo = state.get("homework_photo")
+    if not isinstance(photo, str):
+        return
+    try:
+        data, declared = decode_data_url(photo)
+        mime = sniff_image_mime(data[:16]) or declared or "application/octet-stream"
+        state["homework_photo"] = put_blob(data, mime)
+    except ValueError as e:
+        logger.warning("Фото домашки не перенесено (%s), удалено из записи", e)
+        state.pop("homework_photo", None)
+
+
+# (target version, step) — each step upgrades a raw stored dict in place.
+# Missing fields are filled by UserState.from_dict(), so steps only handle
+# changes of shape or meaning.
+_MIGRATIONS: List[Tuple[int, Callable[[Dict[str, Any]], None]]] = [
+    (1, _migrate_photo_to_blob),
+]
+
+
+def _upgrade_record(state: Dict[str, Any]) -> bool:
+    """Run pending migration steps on one stored record. True if upgraded."""
+    version = state.get("schema_version", 0)
+    if version >= SCHEMA_VERSION:
+        return False
+    for target, step in _MIGRATIONS:
+        if version < target:
+            step(state)
+    state["schema_version"] = SCHEMA_VERSION
+    return True
+
+
+def save_progress(user_id: Optional[int] = None):
+    """Mark progress dirty and schedule a group commit.
 
+    With the background flusher running, every save within SAVE_WINDOW_SECS
+    collapses into one commit, and the disk write happens on the
+    progress-writer thread. Without it (scripts, before startup) the commit
+    happens immediately. user_id=None marks the whole dataset dirty.
+    Inside transaction() the save is deferred to the end of the block.
+    """
+    tx = _current_tx.get()
+    if tx is not None:
+        if user_id is None:
+            tx.full = True
+        else:
+            tx.dirty.add(user_id)
+        return
+    _schedule_commit(() if user_id is None else (user_id,), full=user_id is None)
+
+
+def _schedule_commit(user_ids, full: bool = False):
+    global _save_scheduled, _full_save_pending
+    _sync_indexes(user_ids, full)
+    with _dirty_lock:
+        if full:
+            _full_save_pending = True
+        _dirty_users.update(user_ids)
+        loop = _flush_loop
+        if loop is not None and _save_scheduled:
+            return
+        _save_scheduled = loop is not None
+    if loop is None:
+        flush_progress()
+        return
+    try:
+        loop.call_soon_threadsafe(loop.call_later, SAVE_WINDOW_SECS, flush_progress)
+    except RuntimeError:
+        # Loop already closed (shutdown race) — fall back to a direct commit
+        flush_progress()
+
+
+def _sync_indexes(user_ids, full: bool = False) -> None:
+    """Update the admin secondary indexes and reminders for users being committed."""
+    if full:
+        user_index.rebuild(user_progress.items())
+        reminder_schedule.rebuild(user_progress.items())
+        return
+    for uid in user_ids:
+        state = user_progress.get(uid)
+        if state is None:
+            user_index.remove(uid)
+            reminder_schedule.remove(uid)
+        else:
+            user_index.sync(uid, state)
+            reminder_schedule.sync(uid, state)
+
+
+@contextmanager
+def transaction(user_id: int) -> Iterator[UserState]:
+    """Unit of work over one user's record.
+
+        with transaction(user_id) as state:
+            state.homework_status = "approved"
+            add_xp(user_id, 100)
+
+    The users it opens, plus any saved inside the block (directly or by
+    helpers such as add_xp/award_badge), are committed once on exit. If the
+    block raises, every user opened with transaction() is restored to its
+    entry state and nothing is saved. Nested blocks join the outer one.
+    Keep the block free of awaits: rollback restores whole records.
+    """
+    tx = _current_tx.get()
+    if tx is not None:
+        if user_id not in tx.snapshots:
+            tx.snapshots[user_id] = _snapshot_user(user_id)
+        yield get_user_state(user_id)
+        return
 
-def save_progress():
-    """Save user progress to JSON file with atomic write and file locking."""
+    tx = _Transaction()
+    tx.snapshots[user_id] = _snapshot_user(user_id)
+    token = _current_tx.set(tx)
     try:
-        tmp = PROGRESS_FILE.with_suffix(".tmp")
-        with open(tmp, "w", encoding="utf-8") as f:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            try:
-                json.dump(user_progress, f, ensure_ascii=False, indent=2)
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-        tmp.replace(PROGRESS_FILE)
+        yield get_user_state(user_id)
+    except BaseException:
+        _current_tx.reset(token)
+        for uid, snap in tx.snapshots.items():
+            if snap is None:
+                user_progress.pop(uid, None)
+                xp_index.remove(uid)
+                user_index.remove(uid)
+                reminder_schedule.remove(uid)
+            else:
+                user_progress[uid] = UserState.from_dict(snap)
+                _reindex_xp(uid)
+                user_index.sync(uid, user_progress[uid])
+                reminder_schedule.sync(uid, user_progress[uid])
+        _invalidate_period_totals()
+        raise
+    _current_tx.reset(token)
+    _schedule_commit(tx.dirty.union(tx.snapshots), full=tx.full)
+
+
+def _snapshot_user(user_id: int) -> Optional[Dict[str, Any]]:
+    """Deep copy of a user's record for rollback; None if the user does not exist."""
+    state = user_progress.get(user_id)
+    return copy.deepcopy(state.to_dict()) if state is not None else None
+
+
+def flush_progress():
+    """Encode all dirty users and hand them to the writer as one commit.
+
+    Runs on the event loop, so records are serialized without racing the
+    handlers that mutate them; only the encoded rows cross to the writer.
+    """
+    global _save_scheduled, _full_save_pending
+    with _dirty_lock:
+        dirty, full = _dirty_users.copy(), _full_save_pending
+        _dirty_users.clear()
+        _full_save_pending = False
+        _save_scheduled = False
+    if not dirty and not full:
+        return
+    try:
+        uids = list(user_progress) if full else [uid for uid in dirty if uid in user_progress]
+        rows = [encode_record(uid, user_progress[uid].to_dict()) for uid in uids]
     except Exception as e:
         logger.error("Ошибка сохранения прогресса: %s", e)
+        return
+    _writer.submit(rows, full=full)
+
+
+def start_background_flush():
+    """Enable write-behind on the running event loop (call from lifespan startup)."""
+    global _flush_loop
+    _writer.start()
+    _flush_loop = asyncio.get_running_loop()
+
+
+def stop_background_flush():
+    """Disable write-behind, commit anything still pending and stop the writer."""
+    global _flush_loop
+    _flush_loop = None
+    flush_progress()
+    _writer.stop()
+
+
+def run_on_loop(fn: Callable[..., Any], *args: Any) -> Any:
+    """Run fn(*args) on the event loop that owns user_progress; return its result.
+
+    Webhook handlers run on inbox worker threads. Whatever they read or
+    change in progress state (records, xp/user indexes, reminders, the
+    review queue) goes through here, so it never interleaves with request
+    handlers or flush_progress(). On the loop itself, or before startup,
+    fn runs inline.
+    """
+    loop = _flush_loop
+    if loop is None:
+        return fn(*args)
+    try:
+        if asyncio.get_running_loop() is loop:
+            return fn(*args)
+    except RuntimeError:
+        pass   # no loop in this thread: a worker
+
+    async def call():
+        return fn(*args)
+
+    return asyncio.run_coroutine_threadsafe(call(), loop).result()
+
+
+def compact_progress():
+    """Fold the journal into a fresh snapshot (on the writer thread if running)."""
+    _writer.compact()
+
+
+async def start_compaction_loop():
+    """Background loop — compact the journal every JOURNAL_COMPACT_INTERVAL s."""
+    if not JOURNAL_MODE:
+        return
+    while True:
+        await asyncio.sleep(JOURNAL_COMPACT_INTERVAL)
+        if _journal.records:
+            compact_progress()
 
 
 # ── USER STATE ────────────────────────────────────────────────────────────────
 
-def get_user_state(user_id: int) -> Dict[str, Any]:
-    """Get or create user state dict. Ensures all fields exist via back-compat defaults."""
-    if user_id not in user_progress:
-        user_progress[user_id] = {
-            "name": str(user_id),
-            "xp": 0,
-            "level": 1,
-            "rank": "Наблюдатель рынка",
-            "module_index": 0,
-            "completed_quests": [],
-            "active_quest": None,
-            "homework_status": "idle",
-            "module_deadline": None,
-            "deadline_extensions": 0,
-            "quiz_state": None,
-            # ── New fields ──
-            "streak": 0,
-            "last_active_date": None,
-            "badges": [],
-            "daily_bonus_claimed": None,
-            "module_unlocked": [0],  # free module always unlocked
-        }
-    state = user_progress[user_id]
-    # Back-compat: ensure new fields on old user records
-    state.setdefault("streak", 0)
-    state.setdefault("last_active_date", None)
-    state.setdefault("badges", [])
-    state.setdefault("daily_bonus_claimed", None)
-    state.setdefault("module_unlocked", [0])
+def get_user_state(user_id: int) -> UserState:
+    """Get or create the user's record. Defaults come from UserState itself.
+
+    Creating paths only (/api/user/init and mutations of known users);
+    lookups that must not add records use peek_user_state().
+    """
+    state = user_progress.get(user_id)
+    if state is None:
+        state = user_progress[user_id] = UserState(name=str(user_id))
+        xp_index.update(user_id, state.xp)
     return state
 
 
+def peek_user_state(user_id: int) -> Optional[UserState]:
+    """Read-only lookup. None for ids that never opened the app."""
+    return user_progress.get(user_id)
+
+
 # ── LEVELS & RANKS ────────────────────────────────────────────────────────────
 
 def get_level_and_rank(xp: int) -> Tuple[int, str]:
@@ -216,12 +503,13 @@ def get_next_level_xp(current_xp: int) -> int:
 def add_xp(user_id: int, amount: int) -> Tuple[int, bool]:
     """Add XP to user, recalculate level/rank, save. Returns (new_level, leveled_up)."""
     state = get_user_state(user_id)
-    old_level = state["level"]
-    state["xp"] += amount
-    new_level, new_rank = get_level_and_rank(state["xp"])
-    state["level"] = new_level
-    state["rank"] = new_rank
-    save_progress()
+    old_level = state.level
+    state.xp += amount
+    state.level, state.rank = get_level_and_rank(state.xp)
+    new_level = state.level
+    _reindex_xp(user_id)
+    _record_xp_gain(user_id, state, amount)
+    save_progress(user_id)
     leveled_up = new_level > old_level
     return new_level, leveled_up
 
@@ -232,51 +520,49 @@ def update_streak(user_id: int) -> Tuple[int, bool]:
     """Update daily login streak. Returns (streak_count, is_new_day)."""
     state = get_user_state(user_id)
     today = date.today().isoformat()
-    last = state.get("last_active_date")
+    last = state.last_active_date
 
     if last == today:
-        return state["streak"], False   # already visited today
+        return state.streak, False   # already visited today
 
     yesterday = (date.today() - timedelta(days=1)).isoformat()
     if last == yesterday:
-        state["streak"] = state.get("streak", 0) + 1
+        state.streak += 1
     else:
-        state["streak"] = 1  # streak broken or first visit
+        state.streak = 1  # streak broken or first visit
 
-    state["last_active_date"] = today
+    state.last_active_date = today
+    xp_index.touch()   # streak is shown on the leaderboard
 
-    streak = state["streak"]
+    streak = state.streak
 
     # Milestone badges & bonus XP
-    if streak == 3 and "streak_3" not in state["badges"]:
-        state["badges"].append("streak_3")
-        state["xp"] += 30
-        new_level, new_rank = get_level_and_rank(state["xp"])
-        state["level"] = new_level
-        state["rank"] = new_rank
-
-    if streak == 7 and "streak_7" not in state["badges"]:
-        state["badges"].append("streak_7")
-        state["xp"] += 100          # bonus XP for 7-day streak
-        new_level, new_rank = get_level_and_rank(state["xp"])
-        state["level"] = new_level
-        state["rank"] = new_rank
-
-    if streak == 30 and "streak_30" not in state["badges"]:
-        state["badges"].append("streak_30")
-        state["xp"] += 500          # bonus XP for 30-day streak
-        new_level, new_rank = get_level_and_rank(state["xp"])
-        state["level"] = new_level
-        state["rank"] = new_rank
-
-    if streak == 60 and "streak_60" not in state["badges"]:
-        state["badges"].append("streak_60")
-        state["xp"] += 1000
-        new_level, new_rank = get_level_and_rank(state["xp"])
-        state["level"] = new_level
-        state["rank"] = new_rank
-
-    save_progress()
+    if streak == 3 and "streak_3" not in state.badges:
+        state.badges.append("streak_3")
+        state.xp += 30
+        state.level, state.rank = get_level_and_rank(state.xp)
+        _record_xp_gain(user_id, state, 30)
+
+    if streak == 7 and "streak_7" not in state.badges:
+        state.badges.append("streak_7")
+        state.xp += 100          # bonus XP for 7-day streak
+        state.level, state.rank = get_level_and_rank(state.xp)
+        _record_xp_gain(user_id, state, 100)
+
+    if streak == 30 and "streak_30" not in state.badges:
+        state.badges.append("streak_30")
+        state.xp += 500          # bonus XP for 30-day streak
+        state.level, state.rank = get_level_and_rank(state.xp)
+        _record_xp_gain(user_id, state, 500)
+
+    if streak == 60 and "streak_60" not in state.badges:
+        state.badges.append("streak_60")
+        state.xp += 1000
+        state.level, state.rank = get_level_and_rank(state.xp)
+        _record_xp_gain(user_id, state, 1000)
+
+    _reindex_xp(user_id)
+    save_progress(user_id)
     return streak, True
 
 
@@ -285,29 +571,29 @@ def claim_daily_bonus(user_id: int) -> Tuple[int, bool]:
     state = get_user_state(user_id)
     today = date.today().isoformat()
 
-    if state.get("daily_bonus_claimed") == today:
+    if state.daily_bonus_claimed == today:
         return 0, False
 
-    state["daily_bonus_claimed"] = today
+    state.daily_bonus_claimed = today
     add_xp(user_id, DAILY_BONUS_XP)
     return DAILY_BONUS_XP, True
 
 
 # ── DEADLINE SYSTEM ───────────────────────────────────────────────────────────
 
-def set_module_deadline(state: Dict[str, Any], hours: int = DEFAULT_DEADLINE_HOURS):
+def set_module_deadline(state: UserState, hours: int = DEFAULT_DEADLINE_HOURS):
     """Set 72-hour deadline for a module. Module 0 (free) gets no deadline."""
-    if state.get("module_index", 0) == 0:
-        state["module_deadline"] = None   # free module — no timer
+    if state.module_index == 0:
+        state.module_deadline = None   # free module — no timer
         return
     deadline = datetime.utcnow() + timedelta(hours=hours)
-    state["module_deadline"] = deadline.isoformat()
-    state["deadline_extensions"] = 0     # reset extensions for new module
+    state.module_deadline = deadline.isoformat()
+    state.deadline_extensions = 0     # reset extensions for new module
 
 
-def is_deadline_expired(state: Dict[str, Any]) -> bool:
+def is_deadline_expired(state: UserState) -> bool:
     """Check if the module deadline has passed."""
-    dl = state.get("module_deadline")
+    dl = state.module_deadline
     if not dl:
         return False
     try:
@@ -316,9 +602,9 @@ def is_deadline_expired(state: Dict[str, Any]) -> bool:
         return False
 
 
-def get_deadline_hours_remaining(state: Dict[str, Any]) -> float:
+def get_deadline_hours_remaining(state: UserState) -> float:
     """Returns hours remaining until deadline. +inf if no deadline. Negative if expired."""
-    dl = state.get("module_deadline")
+    dl = state.module_deadline
     if not dl:
         return float("inf")
     try:
@@ -328,16 +614,63 @@ def get_deadline_hours_remaining(state: Dict[str, Any]) -> float:
         return float("inf")
 
 
-def apply_penalty_extension(state: Dict[str, Any]) -> bool:
+def apply_penalty_extension(state: UserState) -> bool:
     """Apply 48-hour penalty extension (first miss). Returns False if already extended."""
-    if state.get("deadline_extensions", 0) >= MAX_EXTENSIONS:
+    if state.deadline_extensions >= MAX_EXTENSIONS:
         return False
     new_dl = datetime.utcnow() + timedelta(hours=48)
-    state["module_deadline"] = new_dl.isoformat()
-    state["deadline_extensions"] = state.get("deadline_extensions", 0) + 1
+    state.module_deadline = new_dl.isoformat()
+    state.deadline_extensions += 1
     return True
 
 
+def extend_deadline(state: UserState, days: int) -> datetime:
+    """Admin extension: push the deadline back by `days` (from now if none is set).
+
+    Does not count against MAX_EXTENSIONS. Returns the new deadline.
+    """
+    base = _parse_deadline(state.module_deadline) or datetime.utcnow()
+    new_dl = base + timedelta(days=days)
+    state.module_deadline = new_dl.isoformat()
+    return new_dl
+
+
+def _parse_deadline(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+# ── REMINDERS ─────────────────────────────────────────────────────────────────
+# reminder_schedule is re-armed on commit; this loop only pops what is due.
+
+REMINDER_MAX_SLEEP_SECS = 60   # also bounds how late a freshly armed reminder can be
+
+
+async def start_reminder_loop(notify_deadline: Callable[[int, float], None],
+                              notify_inactivity: Callable[[int, str], None]):
+    """Background loop — send 24h/6h/1h deadline and inactivity reminders as they fall due."""
+    while True:
+        try:
+            for uid, kind, hours in reminder_schedule.due():
+                state = user_progress.get(uid)
+                # Submitted work waiting for review needs no nudge
+                if state is None or state.homework_status == "pending":
+                    continue
+                if kind == DEADLINE:
+                    notify_deadline(uid, get_deadline_hours_remaining(state))
+                else:
+                    notify_inactivity(uid, state.name or str(uid))
+        except Exception as e:
+            logger.error("Ошибка отправки напоминаний: %s", e)
+        nxt = reminder_schedule.next_due()
+        delay = REMINDER_MAX_SLEEP_SECS
+        if nxt is not None:
+            delay = min(delay, max(0.0, (nxt - datetime.utcnow()).total_seconds()))
+        await asyncio.sleep(delay)
+
+
 # ── BADGE SYSTEM ─────────────────────────────────────────────────────────────
 
 def award_badge(user_id: int, badge_id: str) -> bool:
@@ -345,10 +678,10 @@ def award_badge(user_id: int, badge_id: str) -> bool:
     if badge_id not in BADGE_DEFS:
         return False
     state = get_user_state(user_id)
-    if badge_id in state["badges"]:
+    if badge_id in state.badges:
         return False
-    state["badges"].append(badge_id)
-    save_progress()
+    state.badges.append(badge_id)
+    save_progress(user_id)
     return True
 
 
@@ -357,42 +690,281 @@ def award_badge(user_id: int, badge_id: str) -> bool:
 def reset_user_progress(user_id: int):
     """Reset user course progress while preserving streak and badges."""
     state = get_user_state(user_id)
-    streak = state.get("streak", 0)
-    last_active = state.get("last_active_date")
-    badges = state.get("badges", [])
-    state.update({
-        "xp": 0, "level": 1, "rank": "Наблюдатель рынка",
-        "module_index": 0, "completed_quests": [],
-        "active_quest": None, "homework_status": "idle",
-        "module_deadline": None, "deadline_extensions": 0,
-        "quiz_state": None,
-        # Preserve streak and badges on reset
-        "streak": streak,
-        "last_active_date": last_active,
-        "badges": badges,
-        "daily_bonus_claimed": None,
-        "module_unlocked": [0],
-    })
-    save_progress()
+    # Streak, last_active_date and badges are preserved on reset
+    state.xp, state.level, state.rank = 0, 1, "Наблюдатель рынка"
+    state.module_index = 0
+    state.completed_quests = []
+    state.active_quest = None
+    state.homework_status = "idle"
+    state.module_deadline = None
+    state.deadline_extensions = 0
+    state.quiz_state = None
+    state.daily_bonus_claimed = None
+    state.module_unlocked = [0]
+    state.xp_days = {}
+    _reindex_xp(user_id)
+    _invalidate_period_totals()
+    save_progress(user_id)
 
 
 # ── LEADERBOARD ───────────────────────────────────────────────────────────────
 
-def get_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
-    """Return top users sorted by XP descending."""
-    entries = [
-        {
-            "user_id": uid,
-            "name": st.get("name", str(uid)),
-            "xp": st.get("xp", 0),
-            "level": st.get("level", 1),
-            "rank": st.get("rank", "Наблюдатель рынка"),
-            "module": st.get("module_index", 0) + 1,
-            "streak": st.get("streak", 0),
-        }
-        for uid, st in user_progress.items()
+def _reindex_xp(user_id: int) -> None:
+    """Move a user to their current XP position in the leaderboard index."""
+    state = user_progress.get(user_id)
+    if state is not None:
+        xp_index.update(user_id, state.xp)
+
+
+def _leaderboard_entry(uid: int, xp: int) -> Dict[str, Any]:
+    st = user_progress[uid]
+    return {
+        "user_id": uid,
+        "name": st.name or str(uid),
+        "xp": xp,
+        "level": st.level,
+        "rank": st.rank,
+        "module": st.module_index + 1,
+        "streak": st.streak,
+    }
+
+
+def get_leaderboard(limit: int = 10, period: Optional[str] = None,
+                    after: Optional[Tuple[int, int]] = None) -> List[Dict[str, Any]]:
+    """Return top users sorted by XP descending.
+
+    Lifetime order comes from xp_index, so only the `limit` returned users
+    are read. For a period ("week", "month") "xp" is the XP gained in that
+    rolling window, and only users active in it are ranked.
+    `after` is an (xp, user_id) cursor: the page starts right below it.
+    """
+    if period is None:
+        pairs = xp_index.top(limit) if after is None else xp_index.after(*after, limit)
+    else:
+        totals = period_xp_totals(period).items()
+        if after is not None:
+            cursor = (-after[0], after[1])
+            totals = [(uid, xp) for uid, xp in totals if (-xp, uid) > cursor]
+        pairs = select_top(totals, limit)
+        pairs.sort(key=lambda pair: (-pair[1], pair[0]))
+    return [_leaderboard_entry(uid, xp) for uid, xp in pairs]
+
+
+def leaderboard_version(period: Optional[str] = None) -> str:
+    """Opaque version of a leaderboard; changes whenever its content may change.
+
+    Period boards also roll over at midnight, so the date is part of it.
+    """
+    if period is None:
+        return str(xp_index.version)
+    return f"{xp_index.version}-{period}-{date.today().isoformat()}"
+
+
+def touch_leaderboard() -> None:
+    """Invalidate leaderboard ETags after a change to a displayed field."""
+    xp_index.touch()
+
+
+# ── ADMIN QUERIES ─────────────────────────────────────────────────────────────
+
+ADMIN_SORT_FIELDS = ("xp", "name", "module_index", "deadline", "user_id")
+
+
+def query_users(homework_status: Optional[str] = None, module_index: Optional[int] = None,
+                expired: Optional[bool] = None, has_photo: Optional[bool] = None,
+                sort: str = "xp", descending: bool = True,
+                offset: int = 0, limit: int = 50) -> Tuple[int, List[int]]:
+    """Filter users via user_index, sort, and page. Returns (total, page user ids).
+
+    sort="xp" needs no sort: without filters the page is a slice of
+    xp_index, with filters xp_index is walked in order until the page is
+    full. Other fields select just the first offset + limit users with a
+    heap (O(n log k)) instead of sorting the whole subset.
+    """
+    unfiltered = homework_status is None and module_index is None and expired is None and has_photo is None
+    if sort == "xp" and unfiltered:
+        total = len(xp_index)
+        if descending:
+            return total, [uid for uid, _xp in xp_index.top(limit, offset)]
+        end = max(0, total - offset)
+        start = max(0, end - limit)
+        return total, [uid for uid, _xp in reversed(xp_index.top(end - start, start))]
+    # Unfiltered pages read the user dict directly rather than copying its keys
+    ids = user_progress if unfiltered else user_index.query(homework_status, module_index, expired, has_photo)
+    total = len(ids)
+    if sort == "xp":
+        matches = (uid for uid in xp_index.ids(descending) if uid in ids)
+        return total, list(islice(matches, offset, offset + limit))
+    if sort == "name":
+        key = lambda uid: ((user_progress[uid].name or "").lower(), uid)
+    elif sort == "module_index":
+        key = lambda uid: (user_progress[uid].module_index, uid)
+    elif sort == "deadline":
+        # Users without a deadline sort after every dated one
+        key = lambda uid: (user_progress[uid].module_deadline is None,
+                           user_progress[uid].module_deadline or "", uid)
+    else:
+        key = lambda uid: uid
+    select = heapq.nlargest if descending else heapq.nsmallest
+    return total, select(offset + limit, ids, key=key)[offset:]
+
+
+def admin_summary() -> Dict:
+    """Dashboard aggregates kept by user_index on every commit (no scan).
+
+    The XP histogram buckets users by SMC level, so each bucket spans one
+    level threshold range.
+    """
+    summary = user_index.summary()
+    by_level = summary.pop("by_level")
+    bounds = [threshold for threshold, _lvl, _name in SMC_LEVELS[1:]] + [None]
+    summary["xp_histogram"] = [
+        {"level": lvl, "rank": name, "xp_min": threshold, "xp_max": upper,
+         "users": by_level.get(lvl, 0)}
+        for (threshold, lvl, name), upper in zip(SMC_LEVELS, bounds)
     ]
-    return sorted(entries, key=lambda x: x["xp"], reverse=True)[:limit]
+    return summary
+
+
+# Export columns: every schema field except blob references (the homework
+# photo stays in the blob store), plus dotted pet.* / dna.* sub-fields.
+EXPORT_EXCLUDED = frozenset({"homework_photo"})
+EXPORT_COLUMNS: Tuple[str, ...] = (
+    ("user_id",)
+    + tuple(f for f in UserState._FIELDS if f not in EXPORT_EXCLUDED)
+    + tuple(f"pet.{f}" for f in PetState._FIELDS)
+    + tuple(f"dna.{f}" for f in DnaStats._FIELDS)
+)
+# Flat scalar fields; nested records and history are opt-in via `columns`
+EXPORT_DEFAULT_COLUMNS: Tuple[str, ...] = tuple(
+    c for c in EXPORT_COLUMNS
+    if "." not in c and c not in ("pet", "dna", "quiz_state", "xp_days")
+)
+
+
+def export_row(user_id: int, state: UserState, columns: Tuple[str, ...]) -> Dict[str, Any]:
+    """Project one user onto export columns (nested records as plain dicts)."""
+    row: Dict[str, Any] = {}
+    for col in columns:
+        if col == "user_id":
+            row[col] = user_id
+            continue
+        record, _, field = col.rpartition(".")
+        value = getattr(getattr(state, record) if record else state, field)
+        row[col] = value.to_dict() if hasattr(value, "to_dict") else value
+    return row
+
+
+# ── PERIOD XP ─────────────────────────────────────────────────────────────────
+# Each UserState keeps xp_days (ISO date → XP gained). Rolling totals per
+# period are rebuilt once per day and then bumped by every gain.
+
+_period_day: Optional[str] = None
+_period_totals: Dict[str, Dict[int, int]] = {period: {} for period in LEADERBOARD_PERIODS}
+
+
+def _period_cutoff(days: int, today: date) -> str:
+    return (today - timedelta(days=days - 1)).isoformat()
+
+
+def _invalidate_period_totals() -> None:
+    global _period_day
+    _period_day = None
+
+
+def _record_xp_gain(user_id: int, state: UserState, amount: int) -> None:
+    """Add a gain to today's bucket and the rolling totals; drop expired days."""
+    if amount <= 0:
+        return
+    today = date.today()
+    key = today.isoformat()
+    days = state.xp_days
+    days[key] = days.get(key, 0) + amount
+    if len(days) > XP_HISTORY_DAYS:
+        cutoff = _period_cutoff(XP_HISTORY_DAYS, today)
+        for day in [d for d in days if d < cutoff]:
+            del days[day]
+    if _period_day == key:
+        for totals in _period_totals.values():
+            totals[user_id] = totals.get(user_id, 0) + amount
+
+
+def period_xp_totals(period: str) -> Dict[int, int]:
+    """user_id → XP gained in the rolling period, for users with any gain.
+
+    Raises KeyError for an unknown period.
+    """
+    global _period_day
+    if period not in LEADERBOARD_PERIODS:
+        raise KeyError(period)
+    today = date.today()
+    if _period_day != today.isoformat():
+        for name, length in LEADERBOARD_PERIODS.items():
+            cutoff = _period_cutoff(length, today)
+            totals = {}
+            for uid, st in user_progress.items():
+                gained = sum(xp for day, xp in st.xp_days.items() if day >= cutoff)
+                if gained:
+                    totals[uid] = gained
+            _period_totals[name] = totals
+        _period_day = today.isoformat()
+    return _period_totals[period]
+
+
+def award_period_badges(period: str = "week") -> Dict[str, List[int]]:
+    """Award "ghost" (top 1% of the period) and "top_3" from period XP.
+
+    Both cuts are taken with quickselect over the period totals. Badges are
+    permanent, so users who already hold one are skipped by award_badge().
+    Returns the user ids newly awarded per badge.
+    """
+    totals = period_xp_totals(period)
+    awarded: Dict[str, List[int]] = {"ghost": [], "top_3": []}
+    if not totals:
+        return awarded
+    ghost_k = max(1, math.ceil(len(totals) * 0.01))
+    for badge, k in (("ghost", ghost_k), ("top_3", 3)):
+        for uid, _xp in select_top(totals.items(), k):
+            if award_badge(uid, badge):
+                awarded[badge].append(uid)
+    if awarded["ghost"] or awarded["top_3"]:
+        logger.info("Бейджи периода %s: ghost=%s top_3=%s", period, awarded["ghost"], awarded["top_3"])
+    return awarded
+
+
+async def start_period_badge_loop():
+    """Background loop — award weekly badges every PERIOD_BADGE_INTERVAL s."""
+    while True:
+        await asyncio.sleep(PERIOD_BADGE_INTERVAL)
+        try:
+            award_period_badges("week")
+        except Exception as e:
+            logger.error("Ошибка выдачи бейджей периода: %s", e)
+
+
+def get_user_rank(user_id: int, k: int = 2) -> Optional[Dict[str, Any]]:
+    """Position of one user: rank, percentile and ±k neighbours. None if unknown.
+
+    percentile is the share of users at or below this position
+    (100 for first place).
+    """
+    position = xp_index.rank(user_id)
+    if position is None:
+        return None
+    total = len(xp_index)
+    neighbours = []
+    first = max(1, position - k)
+    for offset, (uid, xp) in enumerate(xp_index.around(user_id, k)):
+        entry = _leaderboard_entry(uid, xp)
+        entry["position"] = first + offset
+        neighbours.append(entry)
+    return {
+        "user_id": user_id,
+        "position": position,
+        "total": total,
+        "percentile": round((total - position + 1) / total * 100, 1),
+        "neighbours": neighbours,
+    }
 
 
 load_progress()
@@ -452,35 +1024,33 @@ _COMBO_WINDOW_SECS = 5    # consecutive taps within this window count as combo
 _MAX_COMBO = 10
 
 
-def _default_pet() -> Dict[str, Any]:
-    now = datetime.utcnow().isoformat()
-    return {
-        "hunger":          80,
-        "happiness":       80,
-        "health":          100,
-        "pet_xp":          0,
-        "pet_level":       1,
-        "coins":           0,
-        "last_updated":    now,
-        "last_tap":        None,
-        "tap_combo":       0,
-        "tap_combo_start": None,
-        "total_taps":      0,
-    }
+def pet_decayed_stats(pet: PetState, now: Optional[datetime] = None) -> Dict[str, float]:
+    """Current hunger/happiness/health: stored base values decayed since last_updated.
+
+    Pure — the pet is not modified, so reads can call it freely.
+    """
+    stats = {stat: getattr(pet, stat) for stat in _PET_DECAY_PER_HOUR}
+    if not pet.last_updated:
+        return stats
+    try:
+        now = now or datetime.utcnow()
+        delta_hours = (now - datetime.fromisoformat(pet.last_updated)).total_seconds() / 3600
+    except (TypeError, ValueError):
+        return stats
+    for stat, rate in _PET_DECAY_PER_HOUR.items():
+        stats[stat] = max(0.0, stats[stat] - rate * delta_hours)
+    return stats
+
 
+def decay_pet_stats(pet: PetState) -> PetState:
+    """Fold elapsed decay into the stored base values. Modifies in-place.
 
-def decay_pet_stats(pet: Dict[str, Any]) -> Dict[str, Any]:
-    """Apply time-based stat decay since last_updated. Modifies in-place."""
+    Only mutation paths call this; the caller persists the result.
+    """
     now = datetime.utcnow()
-    last = pet.get("last_updated")
-    if last:
-        try:
-            delta_hours = (now - datetime.fromisoformat(last)).total_seconds() / 3600
-            for stat, rate in _PET_DECAY_PER_HOUR.items():
-                pet[stat] = max(0.0, pet.get(stat, 0) - rate * delta_hours)
-        except Exception:
-            pass
-    pet["last_updated"] = now.isoformat()
+    for stat, value in pet_decayed_stats(pet, now).items():
+        setattr(pet, stat, value)
+    pet.last_updated = now.isoformat()
     return pet
 
 
@@ -492,11 +1062,14 @@ def _get_pet_level(pet_xp: int) -> int:
     return min(level, 20)
 
 
-def get_pet_visual_state(pet: Dict[str, Any]) -> str:
-    """Returns one of: idle | happy | hungry | sick | excited"""
-    hp  = pet.get("health",    100)
-    h   = pet.get("hunger",    100)
-    hap = pet.get("happiness", 100)
+def get_pet_visual_state(pet) -> str:
+    """Returns one of: idle | happy | hungry | sick | excited
+
+    Accepts a PetState or a dict of stats (e.g. a peek_pet_state() view).
+    """
+    hp  = pet["health"]
+    h   = pet["hunger"]
+    hap = pet["happiness"]
     if hp < 30:
         return "sick"
     if h < 25:
@@ -508,21 +1081,37 @@ def get_pet_visual_state(pet: Dict[str, Any]) -> str:
     return "idle"
 
 
-def get_pet_state(user_id: int) -> Dict[str, Any]:
-    """Get full pet state with decay applied. Creates default pet if missing."""
-    state = get_user_state(user_id)
-    if "pet" not in state:
-        state["pet"] = _default_pet()
-    pet = state["pet"]
-    for k, v in _default_pet().items():
-        pet.setdefault(k, v)
+def peek_pet_state(user_id: int) -> Optional[Dict[str, Any]]:
+    """Read-only pet view with decay computed on the fly. None for unknown users.
+
+    Nothing is written, so polling the pet costs no disk I/O.
+    """
+    state = peek_user_state(user_id)
+    if state is None:
+        return None
+    pet = state.pet
+    view = pet.to_dict()
+    view.update(pet_decayed_stats(pet))
+    lvl = _get_pet_level(pet.pet_xp)
+    view["pet_level"] = lvl
+    view["visual_state"] = get_pet_visual_state(view)
+    view["next_level_xp"] = PET_LEVEL_XP[lvl] if lvl < 20 else None
+    view["current_level_xp"] = PET_LEVEL_XP[lvl - 1]
+    return view
+
+
+def get_pet_state(user_id: int) -> PetState:
+    """Pet record prepared for a mutation: decay folded in, derived fields refreshed.
+
+    Callers that change the pet call save_progress() themselves.
+    """
+    pet = get_user_state(user_id).pet
     decay_pet_stats(pet)
-    pet["pet_level"] = _get_pet_level(pet.get("pet_xp", 0))
-    pet["visual_state"] = get_pet_visual_state(pet)
-    lvl = pet["pet_level"]
-    pet["next_level_xp"] = PET_LEVEL_XP[lvl] if lvl < 20 else None
-    pet["current_level_xp"] = PET_LEVEL_XP[lvl - 1]
-    save_progress()
+    pet.pet_level = _get_pet_level(pet.pet_xp)
+    pet.visual_state = get_pet_visual_state(pet)
+    lvl = pet.pet_level
+    pet.next_level_xp = PET_LEVEL_XP[lvl] if lvl < 20 else None
+    pet.current_level_xp = PET_LEVEL_XP[lvl - 1]
     return pet
 
 
@@ -531,7 +1120,7 @@ def pet_register_tap(user_id: int) -> Dict[str, Any]:
     pet = get_pet_state(user_id)
     now = datetime.utcnow()
 
-    last_tap = pet.get("tap_combo_start")
+    last_tap = pet.tap_combo_start
     combo_active = False
     if last_tap:
         try:
@@ -541,15 +1130,15 @@ def pet_register_tap(user_id: int) -> Dict[str, Any]:
             pass
 
     if combo_active:
-        pet["tap_combo"] = min(pet.get("tap_combo", 0) + 1, _MAX_COMBO)
+        pet.tap_combo = min(pet.tap_combo + 1, _MAX_COMBO)
     else:
-        pet["tap_combo"] = 1
-        pet["tap_combo_start"] = now.isoformat()
+        pet.tap_combo = 1
+        pet.tap_combo_start = now.isoformat()
 
-    pet["last_tap"] = now.isoformat()
-    pet["total_taps"] = pet.get("total_taps", 0) + 1
+    pet.last_tap = now.isoformat()
+    pet.total_taps += 1
 
-    combo = pet["tap_combo"]
+    combo = pet.tap_combo
     xp_gain = max(1, round(1 + (combo - 1) * 0.5))
 
     # DATA UNITS awarded per tap (scaled by combo)
@@ -559,42 +1148,42 @@ def pet_register_tap(user_id: int) -> Dict[str, Any]:
         data_tap = 4
     else:
         data_tap = 2
-    pet["coins"] = pet.get("coins", 0) + data_tap
+    pet.coins += data_tap
 
-    pet["happiness"] = min(100, pet.get("happiness", 0) + 2)
-    pet["pet_xp"]    = pet.get("pet_xp", 0) + xp_gain
+    pet.happiness = min(100, pet.happiness + 2)
+    pet.pet_xp   += xp_gain
 
-    old_level = pet.get("pet_level", 1)
-    new_level = _get_pet_level(pet["pet_xp"])
-    pet["pet_level"] = new_level
+    old_level = pet.pet_level
+    new_level = _get_pet_level(pet.pet_xp)
+    pet.pet_level = new_level
     level_up = new_level > old_level
 
     # Milestone bonus coins (stacks on top of per-tap)
     coins_earned = 0
-    total = pet["total_taps"]
+    total = pet.total_taps
     milestone_map = {100: 10, 500: 25, 1000: 50, 5000: 100}
     if total in milestone_map:
         coins_earned = milestone_map[total]
-        pet["coins"] = pet.get("coins", 0) + coins_earned
+        pet.coins += coins_earned
 
-    pet["visual_state"] = get_pet_visual_state(pet)
-    save_progress()
+    pet.visual_state = get_pet_visual_state(pet)
+    save_progress(user_id)
 
-    lvl = pet["pet_level"]
+    lvl = pet.pet_level
     return {
         "xp_gained":        xp_gain,
         "combo":            combo,
-        "pet_xp":           pet["pet_xp"],
+        "pet_xp":           pet.pet_xp,
         "pet_level":        new_level,
         "level_up":         level_up,
         "coins_earned":     coins_earned,
         "data_awarded":     data_tap,
-        "total_data":       pet["coins"],
-        "coins":            pet["coins"],
-        "visual_state":     pet["visual_state"],
-        "hunger":           round(pet["hunger"]),
-        "happiness":        round(pet["happiness"]),
-        "health":           round(pet["health"]),
+        "total_data":       pet.coins,
+        "coins":            pet.coins,
+        "visual_state":     pet.visual_state,
+        "hunger":           round(pet.hunger),
+        "happiness":        round(pet.happiness),
+        "health":           round(pet.health),
         "next_level_xp":    PET_LEVEL_XP[lvl] if lvl < 20 else None,
         "current_level_xp": PET_LEVEL_XP[lvl - 1],
     }
@@ -608,35 +1197,35 @@ def apply_lesson_pet_effect(user_id: int, lesson_key: str, score_pct: float = 10
 
     for stat, val in effects.items():
         if stat == "coins":
-            pet["coins"] = pet.get("coins", 0) + val
+            pet.coins += val
             applied["coins"] = val
         elif stat == "pet_xp":
             bonus = max(1, round(val * score_pct / 100))
-            pet["pet_xp"] = pet.get("pet_xp", 0) + bonus
+            pet.pet_xp += bonus
             applied["pet_xp"] = bonus
         elif stat in ("hunger", "happiness", "health"):
-            pet[stat] = min(100, pet.get(stat, 0) + val)
+            setattr(pet, stat, min(100, getattr(pet, stat) + val))
             applied[stat] = val
 
-    old_level = pet.get("pet_level", 1)
-    pet["pet_level"] = _get_pet_level(pet["pet_xp"])
-    pet["visual_state"] = get_pet_visual_state(pet)
-    save_progress()
+    old_level = pet.pet_level
+    pet.pet_level = _get_pet_level(pet.pet_xp)
+    pet.visual_state = get_pet_visual_state(pet)
+    save_progress(user_id)
 
     return {
         "applied":      applied,
-        "pet_level":    pet["pet_level"],
-        "level_up":     pet["pet_level"] > old_level,
-        "visual_state": pet["visual_state"],
+        "pet_level":    pet.pet_level,
+        "level_up":     pet.pet_level > old_level,
+        "visual_state": pet.visual_state,
     }
 
 
 def add_pet_coins(user_id: int, amount: int) -> int:
     """Add coins to pet wallet. Returns new total."""
     pet = get_pet_state(user_id)
-    pet["coins"] = pet.get("coins", 0) + amount
-    save_progress()
-    return pet["coins"]
+    pet.coins += amount
+    save_progress(user_id)
+    return pet.coins
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -654,12 +1243,12 @@ EVOLUTION_STAGES: List[Dict[str, Any]] = [
 ]
 
 
-def _calc_evolution_stage(state: Dict[str, Any]) -> int:
-    pet       = state.get("pet", {})
-    completed = set(state.get("completed_quests", []))
-    streak    = state.get("streak", 0)
-    oracle_ok = pet.get("oracle_correct", 0)
-    lb_rank   = state.get("leaderboard_rank", 9999)
+def _calc_evolution_stage(state: UserState, lb_rank: Optional[int]) -> int:
+    pet       = state.pet
+    completed = set(state.completed_quests)
+    streak    = state.streak
+    oracle_ok = pet.oracle_correct
+    lb_rank   = lb_rank or 9999
 
     stage = 1
 
@@ -687,14 +1276,14 @@ def _calc_evolution_stage(state: Dict[str, Any]) -> int:
 def check_and_update_evolution(user_id: int) -> Dict[str, Any]:
     """Compute new evolution stage, persist, return result."""
     state     = get_user_state(user_id)
-    pet       = state.setdefault("pet", {})
-    new_stage = _calc_evolution_stage(state)
-    old_stage = pet.get("evolution_stage", 1)
+    pet       = state.pet
+    new_stage = _calc_evolution_stage(state, xp_index.rank(user_id))
+    old_stage = pet.evolution_stage
 
-    pet["evolution_stage"] = new_stage
+    pet.evolution_stage = new_stage
     evolved = new_stage > old_stage
     if evolved:
-        save_progress()
+        save_progress(user_id)
 
     info = EVOLUTION_STAGES[new_stage - 1]
     nxt  = EVOLUTION_STAGES[new_stage] if new_stage < 7 else None
@@ -714,40 +1303,35 @@ def update_trader_dna(user_id: int, event: str, value: Any = 1) -> None:
     event: 'quiz_correct', 'quiz_wrong', 'tap', 'prediction_correct',
            'prediction_wrong', 'lesson_{key}'
     """
-    state = get_user_state(user_id)
-    dna   = state.setdefault("dna", {})
+    dna = get_user_state(user_id).dna
 
     if event == "quiz_correct":
-        dna["quiz_correct"] = dna.get("quiz_correct", 0) + 1
+        dna.quiz_correct += 1
     elif event == "quiz_wrong":
-        dna["quiz_wrong"]   = dna.get("quiz_wrong", 0) + 1
+        dna.quiz_wrong   += 1
     elif event == "tap":
-        dna["total_taps"]   = dna.get("total_taps", 0) + 1
+        dna.total_taps   += 1
     elif event == "prediction_correct":
-        dna["pred_correct"] = dna.get("pred_correct", 0) + 1
+        dna.pred_correct += 1
     elif event == "prediction_wrong":
-        dna["pred_wrong"]   = dna.get("pred_wrong", 0) + 1
+        dna.pred_wrong   += 1
     elif event.startswith("lesson_"):
         key = event[7:]
-        lessons = dna.setdefault("lessons_studied", {})
-        lessons[key] = lessons.get(key, 0) + 1
+        dna.lessons_studied[key] = dna.lessons_studied.get(key, 0) + 1
 
-    save_progress()
+    save_progress(user_id)
 
 
 def get_trader_dna(user_id: int) -> Dict[str, Any]:
-    state = get_user_state(user_id)
-    dna   = state.get("dna", {})
-    qc    = dna.get("quiz_correct", 0)
-    qw    = dna.get("quiz_wrong",   0)
-    pc    = dna.get("pred_correct", 0)
-    pw    = dna.get("pred_wrong",   0)
+    dna   = get_user_state(user_id).dna
+    qc, qw = dna.quiz_correct, dna.quiz_wrong
+    pc, pw = dna.pred_correct, dna.pred_wrong
     acc   = round(qc / (qc + qw) * 100) if (qc + qw) > 0 else None
     pred  = round(pc / (pc + pw) * 100) if (pc + pw) > 0 else None
     return {
         "quiz_accuracy":       acc,
         "prediction_accuracy": pred,
-        "total_taps":          dna.get("total_taps", 0),
-        "lessons_studied":     dna.get("lessons_studied", {}),
-        "raw":                 dna,
+        "total_taps":          dna.total_taps,
+        "lessons_studied":     dna.lessons_studied,
+        "raw":                 dna.to_dict(),
     }
@@ -0,0 +1,336 @@
+"""
+progress_store.py — On-disk persistence for user progress.
+
+Snapshot: the whole dataset as one JSON object (progress_smc.json),
+rewritten atomically via tmp → replace under an exclusive flock.
+
+Journal: an append-only JSON-lines log (progress_smc.journal) holding one
+compact record per changed user. Each record carries the user's complete
+state, so replaying the journal over a snapshot is idempotent — last write
+wins per user, and a crash between "snapshot written" and "journal trimmed"
+loses nothing.
+
+SQLite: one row per user in progress_smc.db (WAL mode), the record as
+JSON, so a save touches only the changed rows. It is a persistence layer
+only: the whole table is loaded at startup and every query (leaderboard,
+admin filters) is answered by the in-memory indexes, so the table carries
+no secondary indexes to keep up on each write.
+
+All three are driven by ProgressWriter, a single background thread that
+receives already-encoded user records; callers never wait on disk.
+"""
+import fcntl
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+# (user_id, json)
+EncodedRecord = Tuple[int, str]
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_record(uid: int, st: Dict[str, Any]) -> EncodedRecord:
+    """Serialize one user record."""
+    return uid, _dumps(st)
+
+
+def _assemble_snapshot(encoded: Dict[int, str]) -> str:
+    """Join per-user JSON fragments into one snapshot object."""
+    return "{" + ",".join(f'"{uid}":{enc}' for uid, enc in encoded.items()) + "}"
+
+
+# ── SNAPSHOT ──────────────────────────────────────────────────────────────────
+
+def read_snapshot(path: Path) -> Dict[int, Dict[str, Any]]:
+    """Read the snapshot file. Returns {} if it does not exist."""
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        try:
+            data = json.load(f)
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    return {int(k): v for k, v in data.items()}
+
+
+def write_snapshot(path: Path, text: str) -> None:
+    """Atomically replace the snapshot with already-encoded JSON text."""
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    tmp.replace(path)
+
+
+# ── JOURNAL ───────────────────────────────────────────────────────────────────
+
+class Journal:
+    """Append-only per-user record log with offset-aware trimming."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.records = 0          # records appended since the last trim
+        self._lock = threading.Lock()
+
+    def append(self, records: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        """Append {"u": user_id, "s": state} lines. Returns records written."""
+        return self.append_encoded(encode_record(uid, st) for uid, st in records)
+
+    def append_encoded(self, rows: Iterable[EncodedRecord]) -> int:
+        """Append pre-encoded records in one write. Returns records written."""
+        lines = [f'{{"u":{row[0]},"s":{row[1]}}}\n' for row in rows]
+        if not lines:
+            return 0
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.write("".join(lines))
+                    f.flush()
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            self.records += len(lines)
+        return len(lines)
+
+    def tell(self) -> int:
+        """Current journal size in bytes (a compaction checkpoint)."""
+        with self._lock:
+            try:
+                return self.path.stat().st_size
+            except FileNotFoundError:
+                return 0
+
+    def replay(self, into: Dict[int, Dict[str, Any]]) -> int:
+        """Apply journal records onto `into`. Returns the number applied.
+
+        A torn last line (crash mid-append) is skipped with a warning.
+        """
+        if not self.path.exists():
+            return 0
+        applied = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                    into[int(rec["u"])] = rec["s"]
+                    applied += 1
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning("Журнал %s:%d пропущен: %s", self.path.name, lineno, e)
+        self.records = applied
+        return applied
+
+    def trim(self, upto: int) -> None:
+        """Drop the first `upto` bytes; records appended after the checkpoint survive."""
+        with self._lock:
+            if not self.path.exists():
+                self.records = 0
+                return
+            with open(self.path, "r+b") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.seek(upto)
+                    tail = f.read()
+                    f.seek(0)
+                    f.write(tail)
+                    f.truncate()
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            self.records = tail.count(b"\n")
+
+
+# ── SQLITE ────────────────────────────────────────────────────────────────────
+
+# Databases created before the table was reduced to (user_id, data) keep
+# their extra columns (all defaulted), but lose the indexes on them.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    data    TEXT NOT NULL
+);
+DROP INDEX IF EXISTS idx_users_xp;
+DROP INDEX IF EXISTS idx_users_module_index;
+DROP INDEX IF EXISTS idx_users_homework_status;
+DROP INDEX IF EXISTS idx_users_module_deadline;
+"""
+
+
+class SqliteStore:
+    """One row per user (WAL mode): the full record as JSON."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def load_all(self) -> Dict[int, Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        return {uid: json.loads(data) for uid, data in rows}
+
+    def upsert(self, records: Iterable[Tuple[int, Dict[str, Any]]]) -> int:
+        """Write the given users in a single transaction. Returns rows written."""
+        return self.upsert_rows([encode_record(uid, st) for uid, st in records])
+
+    def upsert_rows(self, rows: List[EncodedRecord]) -> int:
+        """Write pre-encoded records in a single transaction. Returns rows written."""
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_json_to_sqlite(snapshot: Path, journal: Path, store: SqliteStore) -> int:
+    """One-shot import of snapshot + journal into an SQLite store. Returns users imported."""
+    data = read_snapshot(snapshot)
+    Journal(journal).replay(data)
+    return store.upsert(data.items())
+
+
+# ── WRITER THREAD ─────────────────────────────────────────────────────────────
+
+class ProgressWriter:
+    """Single writer thread that owns all progress I/O.
+
+    submit() takes records already encoded by the caller, so the writer never
+    touches live state. For the snapshot and journal layouts it keeps the
+    latest JSON fragment per user, which lets it rebuild the snapshot without
+    re-encoding unchanged users. Until start() (and after stop()) jobs run
+    inline on the calling thread.
+    """
+
+    def __init__(self, snapshot: Path, journal: Optional[Journal] = None,
+                 sqlite: Optional[SqliteStore] = None, compact_records: int = 5000):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.sqlite = sqlite
+        self.compact_records = compact_records
+        self._encoded: Dict[int, str] = {}
+        self._queue: "queue.Queue[Optional[Tuple[Callable, tuple]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._io_lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        """Jobs waiting for the writer thread."""
+        return self._queue.qsize()
+
+    def seed(self, rows: Iterable[EncodedRecord]) -> None:
+        """Prime the per-user fragment cache after a load."""
+        if self.sqlite is None:
+            with self._io_lock:
+                self._encoded = {row[0]: row[1] for row in rows}
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="progress-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Finish queued jobs and stop the thread."""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+        while True:   # jobs that raced in behind the sentinel
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                self._execute(*job)
+
+    def submit(self, rows: List[EncodedRecord], full: bool = False) -> None:
+        """Persist encoded records. full=True means rows are the whole dataset."""
+        self._dispatch(self._write, rows, full)
+
+    def compact(self) -> None:
+        """Fold the journal into a fresh snapshot."""
+        self._dispatch(self._compact)
+
+    def _dispatch(self, fn: Callable, *args) -> None:
+        if self._thread is None:
+            self._execute(fn, args)
+        else:
+            self._queue.put((fn, args))
+
+    def _execute(self, fn: Callable, args: tuple) -> None:
+        with self._io_lock:
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error("Ошибка записи прогресса: %s", e)
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._execute(*job)
+
+    def _write(self, rows: List[EncodedRecord], full: bool) -> None:
+        if self.sqlite is not None:
+            self.sqlite.upsert_rows(rows)
+            return
+        if full:
+            self._encoded = {row[0]: row[1] for row in rows}
+        else:
+            self._encoded.update((row[0], row[1]) for row in rows)
+        if self.journal is None:
+            write_snapshot(self.snapshot, _assemble_snapshot(self._encoded))
+        elif full:
+            self._compact()
+        else:
+            self.journal.append_encoded(rows)
+            if self.journal.records >= self.compact_records:
+                self._compact()
+
+    def _compact(self) -> None:
+        if self.journal is None:
+            return
+        write_snapshot(self.snapshot, _assemble_snapshot(self._encoded))
+        self.journal.trim(self.journal.tell())
+        logger.info("Журнал прогресса сжат: %d пользователей", len(self._encoded))
@@ -0,0 +1,115 @@
+"""
+reminders.py — Min-heap of upcoming deadline and inactivity reminders.
+
+For each user with a module deadline, the heap holds one entry per
+DEADLINE_REMINDER_HOURS threshold before it (24h, 6h, 1h). It also holds
+one inactivity entry INACTIVITY_HOURS after their last_online. progress.py
+syncs a user on every commit, so anything that moves the deadline
+(set_module_deadline, apply_penalty_extension, extend_deadline) or records
+activity re-arms their reminders. due() pops only what is due, at
+O(log n) per entry, so nothing scans the user population.
+
+Superseded entries are not searched for and removed. Each entry carries
+the deadline / last_online string it was computed from, and pop
+discards any entry that no longer matches the user's current value. The
+heap is rebuilt from live entries once stale ones dominate.
+
+Reminders whose time passed while the process was down are not replayed
+after a restart, so a restart never repeats a reminder already sent.
+"""
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+DEADLINE_REMINDER_HOURS = (24, 6, 1)
+INACTIVITY_HOURS = 48
+
+DEADLINE = "deadline"
+INACTIVITY = "inactivity"
+
+# (due, seq, user_id, kind, hours before the deadline or 0, source value)
+_Entry = Tuple[datetime, int, int, str, int, str]
+
+
+def _parse(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ReminderSchedule:
+    """Due-time ordered reminders, kept in step with user records on commit."""
+
+    def __init__(self):
+        self._heap: List[_Entry] = []
+        self._seq = itertools.count()
+        # user_id → (module_deadline, last_online) the user's entries were built from
+        self._sources: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def rebuild(self, items: Iterable[Tuple[int, Any]], now: Optional[datetime] = None) -> None:
+        """Re-arm every user from scratch (used after a load)."""
+        self._heap.clear()
+        self._sources.clear()
+        for uid, state in items:
+            self.sync(uid, state, now)
+
+    def sync(self, user_id: int, state: Any, now: Optional[datetime] = None) -> None:
+        """Re-arm one user's reminders if their deadline or activity changed."""
+        deadline = state.module_deadline or None
+        # Inactivity nudges only matter while a deadline is running
+        last_online = state.last_online if deadline else None
+        old = self._sources.get(user_id, (None, None))
+        if old == (deadline, last_online):
+            return
+        self._sources[user_id] = (deadline, last_online)
+        now = now or datetime.utcnow()
+        deadline_dt = _parse(deadline)
+        if deadline != old[0] and deadline_dt is not None:
+            for hours in DEADLINE_REMINDER_HOURS:
+                due = deadline_dt - timedelta(hours=hours)
+                if due > now:
+                    self._push(due, user_id, DEADLINE, hours, deadline)
+        last_dt = _parse(last_online)
+        if last_online != old[1] and last_dt is not None and deadline_dt is not None and deadline_dt > now:
+            due = last_dt + timedelta(hours=INACTIVITY_HOURS)
+            if now < due < deadline_dt:
+                self._push(due, user_id, INACTIVITY, 0, last_online)
+        if len(self._heap) > 4 * len(self._sources) + 1024:
+            self._compact()
+
+    def remove(self, user_id: int) -> None:
+        """Forget a user; their entries are discarded as they surface."""
+        self._sources.pop(user_id, None)
+
+    def next_due(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now: Optional[datetime] = None) -> List[Tuple[int, str, int]]:
+        """Pop every live reminder due by `now` as (user_id, kind, hours)."""
+        now = now or datetime.utcnow()
+        out = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._live(entry):
+                _due, _seq, uid, kind, hours, _source = entry
+                out.append((uid, kind, hours))
+        return out
+
+    def _push(self, due: datetime, user_id: int, kind: str, hours: int, source: str) -> None:
+        heapq.heappush(self._heap, (due, next(self._seq), user_id, kind, hours, source))
+
+    def _live(self, entry: _Entry) -> bool:
+        _due, _seq, uid, kind, _hours, source = entry
+        deadline, last_online = self._sources.get(uid, (None, None))
+        return source == (deadline if kind == DEADLINE else last_online)
+
+    def _compact(self) -> None:
+        self._heap = [entry for entry in self._heap if self._live(entry)]
+        heapq.heapify(self._heap)
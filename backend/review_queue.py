@@ -0,0 +1,218 @@
+"""
+review_queue.py — Persisted FIFO of homework submissions awaiting review.
+
+Every submission gets its own entry (id, user, quest, submitted_at, photo
+blob), so a resubmission no longer replaces the one before it. Entries stay
+queued until an admin approves, rejects or requests a revision for that
+user and quest.
+
+On disk: DATA_DIR/review_queue.jsonl, an append-only log of
+{"op": "push", "item": {...}}, {"op": "pop", "id": n} and
+{"op": "file_id", "id": n, "sha256": "...", "file_id": "..."} lines. It is
+replayed at startup and rewritten with only the live entries once pops
+dominate.
+
+file_id is the Telegram id of the photo after its first upload to a
+reviewer. It is kept per blob hash, so the same picture is re-sent by id
+instead of being uploaded again, and is copied onto the entry's photo while
+the entry is queued. The hash → file_id map outlives the entries: a rewrite
+keeps it as id-less file_id lines.
+
+In memory: submission ids in ascending (arrival) order plus an id → entry
+dict. Resolving an entry only removes it from the dict, leaving a lazy
+tombstone in the id list that page reads skip. The id list is compacted
+when tombstones outnumber live entries.
+"""
+import json
+import logging
+import os
+import threading
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_data_dir = Path(os.getenv("DATA_DIR", "."))
+REVIEW_QUEUE_FILE = _data_dir / "review_queue.jsonl"
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+class ReviewQueue:
+    """Oldest-first queue of pending homework submissions."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids: List[int] = []                          # ascending, may hold tombstones
+        self._items: Dict[int, Dict[str, Any]] = {}        # live entries
+        self._by_key: Dict[Tuple[int, str], List[int]] = {}
+        self._file_ids: Dict[str, str] = {}                # blob sha256 → Telegram file_id
+        self._next_id = 1
+        self._log_lines = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    # ── persistence ──────────────────────────────────────────────────────────
+
+    def load(self) -> int:
+        """Replay the log. Returns the number of pending entries."""
+        with self._lock:
+            self._ids, self._items, self._by_key, self._file_ids = [], {}, {}, {}
+            self._next_id, self._log_lines = 1, 0
+            if not self.path.exists():
+                return 0
+            with open(self.path, "r", encoding="utf-8") as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rec = json.loads(line)
+                        if rec["op"] == "push":
+                            self._link(rec["item"])
+                        elif rec["op"] == "pop":
+                            self._unlink(int(rec["id"]))
+                        elif rec["op"] == "file_id":
+                            self._set_file_id(rec.get("id"), rec.get("sha256"), rec["file_id"])
+                        elif rec["op"] == "seq":
+                            self._next_id = max(self._next_id, int(rec["next"]))
+                        self._log_lines += 1
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.warning("Очередь проверки %s:%d пропущена: %s", self.path.name, lineno, e)
+            self._compact_ids()
+            self._maybe_rewrite()
+            return len(self._items)
+
+    def _append(self, records: List[Dict[str, Any]]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(_dumps(rec) + "\n" for rec in records))
+            f.flush()
+        self._log_lines += len(records)
+        self._maybe_rewrite()
+
+    def _maybe_rewrite(self) -> None:
+        """Rewrite the log with live entries (and file_ids) once it is mostly pops."""
+        if self._log_lines <= 2 * (len(self._items) + len(self._file_ids)) + 100:
+            return
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            # Keep ids increasing across rewrites so client cursors stay valid
+            f.write(_dumps({"op": "seq", "next": self._next_id}) + "\n")
+            live_shas = set()
+            for sid in self._ids:
+                item = self._items.get(sid)
+                if item is not None:
+                    f.write(_dumps({"op": "push", "item": item}) + "\n")
+                    if item.get("photo") and item["photo"].get("tg_file_id"):
+                        live_shas.add(item["photo"]["sha256"])
+            # file_ids of resolved submissions are still good for re-sends
+            kept = 0
+            for sha, file_id in self._file_ids.items():
+                if sha not in live_shas:
+                    f.write(_dumps({"op": "file_id", "sha256": sha, "file_id": file_id}) + "\n")
+                    kept += 1
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.path)
+        self._log_lines = len(self._items) + kept + 1
+
+    # ── in-memory structure ──────────────────────────────────────────────────
+
+    def _link(self, item: Dict[str, Any]) -> None:
+        sid = int(item["id"])
+        self._items[sid] = item
+        self._ids.append(sid)   # ids only grow, so the list stays sorted
+        self._by_key.setdefault((item["user_id"], item["quest_id"]), []).append(sid)
+        self._next_id = max(self._next_id, sid + 1)
+        photo = item.get("photo")
+        if photo and photo.get("tg_file_id"):
+            self._file_ids[photo["sha256"]] = photo["tg_file_id"]
+
+    def _set_file_id(self, sid: Optional[int], sha256: Optional[str], file_id: str) -> bool:
+        """Record a file_id for a blob (and on its entry, if still queued)."""
+        item = self._items.get(int(sid)) if sid is not None else None
+        photo = item.get("photo") if item is not None else None
+        if photo:
+            photo["tg_file_id"] = file_id
+            sha256 = photo["sha256"]
+        if not sha256:
+            return False
+        self._file_ids[sha256] = file_id
+        return True
+
+    def _unlink(self, sid: int) -> Optional[Dict[str, Any]]:
+        item = self._items.pop(sid, None)
+        if item is not None:
+            key = (item["user_id"], item["quest_id"])
+            ids = self._by_key.get(key, [])
+            if sid in ids:
+                ids.remove(sid)
+            if not ids:
+                self._by_key.pop(key, None)
+        return item
+
+    def _compact_ids(self) -> None:
+        if len(self._ids) > 2 * len(self._items):
+            self._ids = [sid for sid in self._ids if sid in self._items]
+
+    # ── public API ───────────────────────────────────────────────────────────
+
+    def push(self, user_id: int, quest_id: str, photo: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Queue a submission. Returns the new entry."""
+        with self._lock:
+            item = {
+                "id": self._next_id,
+                "user_id": user_id,
+                "quest_id": quest_id,
+                "submitted_at": datetime.utcnow().isoformat(),
+                # A copy: file_id is added later and must not leak into the user record
+                "photo": dict(photo) if photo else None,
+            }
+            self._link(item)
+            self._append([{"op": "push", "item": item}])
+            return item
+
+    def resolve(self, user_id: int, quest_id: str) -> List[Dict[str, Any]]:
+        """Drop every pending submission of this user for this quest."""
+        with self._lock:
+            ids = list(self._by_key.get((user_id, quest_id), ()))
+            removed = [item for item in (self._unlink(sid) for sid in ids) if item is not None]
+            if removed:
+                self._append([{"op": "pop", "id": item["id"]} for item in removed])
+                self._compact_ids()
+            return removed
+
+    def set_file_id(self, submission_id: int, sha256: str, file_id: str) -> None:
+        """Remember the Telegram file_id of a submission's photo (blob `sha256`).
+
+        Works after the submission was resolved too: the id is kept per blob.
+        """
+        with self._lock:
+            if self._set_file_id(submission_id, sha256, file_id):
+                self._append([{"op": "file_id", "id": submission_id, "sha256": sha256, "file_id": file_id}])
+
+    def file_id_for(self, sha256: str) -> Optional[str]:
+        """Telegram file_id of a photo already sent for review, by blob hash."""
+        return self._file_ids.get(sha256)
+
+    def page(self, after: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
+        """Up to `limit` entries with id > `after`, oldest first."""
+        with self._lock:
+            out: List[Dict[str, Any]] = []
+            i = bisect_right(self._ids, after)
+            while i < len(self._ids) and len(out) < limit:
+                item = self._items.get(self._ids[i])
+                if item is not None:
+                    out.append(dict(item))
+                i += 1
+            return out
+
+
+review_queue = ReviewQueue(REVIEW_QUEUE_FILE)
+review_queue.load()
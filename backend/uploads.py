@@ -0,0 +1,115 @@
+"""
+uploads.py — Streaming multipart/form-data reader for homework uploads.
+
+Starlette's request.form() spools every file part in full before the
+handler runs, so a size limit can only be checked afterwards. Here
+request.stream() goes straight into python-multipart's MultipartParser.
+Small text fields are kept in memory up to a cap. The single file part is
+written chunk by chunk into a blob_store.BlobSink, which rejects oversize
+or non-image data as soon as the offending bytes arrive.
+
+Errors are ValueError (malformed form, unexpected part, not an image) or
+blob_store.BlobTooLarge; the caller maps them to HTTP statuses.
+"""
+import logging
+from typing import Dict, Optional, Tuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+from blob_store import BlobSink, BlobTooLarge
+
+logger = logging.getLogger(__name__)
+
+FIELD_MAX_BYTES = 1024        # text fields are ids, never large
+FORM_OVERHEAD_BYTES = 16_384  # boundaries, part headers and text fields
+
+
+class _FormCollector:
+    """MultipartParser callbacks: text fields to a dict, one file part to a BlobSink."""
+
+    def __init__(self, file_field: str, max_file_bytes: int):
+        self.file_field = file_field
+        self.max_file_bytes = max_file_bytes
+        self.fields: Dict[str, str] = {}
+        self.sink: Optional[BlobSink] = None
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._name: Optional[str] = None
+        self._buf = bytearray()
+        self._to_file = False
+
+    def callbacks(self) -> Dict[str, object]:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        }
+
+    def on_part_begin(self) -> None:
+        self._headers, self._name, self._buf, self._to_file = {}, None, bytearray(), False
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field, self._header_value = b"", b""
+
+    def on_headers_finished(self) -> None:
+        _disposition, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            if self._name != self.file_field or self.sink is not None:
+                raise ValueError(f"unexpected file part {self._name!r}")
+            self.sink = BlobSink(self.max_file_bytes)
+            self._to_file = True
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._to_file:
+            self.sink.write(data[start:end])
+            return
+        self._buf += data[start:end]
+        if len(self._buf) > FIELD_MAX_BYTES:
+            raise ValueError(f"field {self._name!r} is too long")
+
+    def on_part_end(self) -> None:
+        if not self._to_file and self._name:
+            self.fields[self._name] = self._buf.decode("utf-8", "replace")
+
+
+async def read_upload(request: Request, file_field: str,
+                      max_file_bytes: int) -> Tuple[Dict[str, str], Optional[BlobSink]]:
+    """Parse a multipart body as it streams in.
+
+    Returns (text fields, sink holding the file part or None). The caller
+    must commit() or discard() the sink.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("expected multipart/form-data")
+    # A declared length already over the cap is refused before reading a byte
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > max_file_bytes + FORM_OVERHEAD_BYTES:
+        raise BlobTooLarge(f"request body of {declared} bytes")
+
+    collector = _FormCollector(file_field, max_file_bytes)
+    parser = MultipartParser(boundary, callbacks=collector.callbacks())
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+    except Exception:
+        if collector.sink is not None:
+            collector.sink.discard()
+        raise
+    return collector.fields, collector.sink
@@ -0,0 +1,169 @@
+"""
+user_index.py — Secondary indexes over user records for admin queries.
+
+Kept per user: homework_status, module_index, whether a homework photo is
+stored, and the module deadline. Status and module map to sets of user ids.
+Deadlines sit in a list sorted by datetime, so "expired now" is a bisect
+prefix. progress.py syncs a user whenever their record is committed, so the
+admin panel never scans or re-parses the whole population.
+
+The same sync keeps dashboard counters: users per level, users with a live
+streak bucketed by last active day, and running quiz-accuracy sums. summary()
+reads them without touching user records.
+"""
+from bisect import bisect_left, insort
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# (homework_status, module_index, has_photo, deadline,
+#  level, last active day while the streak is alive, quiz_correct, quiz_wrong)
+_IndexedValues = Tuple[str, int, bool, Optional[datetime], int, Optional[str], int, int]
+
+
+def _parse_deadline(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class UserIndex:
+    """Status/module/photo/deadline lookups maintained on commit."""
+
+    def __init__(self):
+        self._values: Dict[int, _IndexedValues] = {}
+        self.by_status: Dict[str, Set[int]] = {}
+        self.by_module: Dict[int, Set[int]] = {}
+        self.with_photo: Set[int] = set()
+        self._deadlines: List[Tuple[datetime, int]] = []   # ascending
+        self.by_level: Dict[int, int] = {}
+        self._active_days: Dict[str, int] = {}
+        self._quiz_correct = 0
+        self._quiz_wrong = 0
+        self._accuracy_sum = 0.0
+        self._accuracy_users = 0
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def rebuild(self, items: Iterable[Tuple[int, Any]]) -> None:
+        """Re-index (user_id, state) pairs from scratch (used after a load)."""
+        self._values.clear()
+        self.by_status.clear()
+        self.by_module.clear()
+        self.with_photo.clear()
+        self._deadlines.clear()
+        self.by_level.clear()
+        self._active_days.clear()
+        self._quiz_correct = self._quiz_wrong = 0
+        self._accuracy_sum, self._accuracy_users = 0.0, 0
+        for uid, state in items:
+            self.sync(uid, state)
+
+    def sync(self, user_id: int, state: Any) -> None:
+        """Bring one user's entries in line with their current state."""
+        values = (
+            state.homework_status or "idle",
+            state.module_index,
+            bool(state.homework_photo),
+            _parse_deadline(state.module_deadline),
+            state.level,
+            state.last_active_date if state.streak > 0 else None,
+            state.dna.quiz_correct,
+            state.dna.quiz_wrong,
+        )
+        old = self._values.get(user_id)
+        if old == values:
+            return
+        if old is not None:
+            self._unlink(user_id, old)
+        self._values[user_id] = values
+        status, module, has_photo, deadline, level, active_day, correct, wrong = values
+        self.by_status.setdefault(status, set()).add(user_id)
+        self.by_module.setdefault(module, set()).add(user_id)
+        if has_photo:
+            self.with_photo.add(user_id)
+        if deadline is not None:
+            insort(self._deadlines, (deadline, user_id))
+        self._count(values, +1)
+
+    def remove(self, user_id: int) -> None:
+        old = self._values.pop(user_id, None)
+        if old is not None:
+            self._unlink(user_id, old)
+
+    def _unlink(self, user_id: int, values: _IndexedValues) -> None:
+        status, module, _has_photo, deadline = values[:4]
+        self._count(values, -1)
+        self.by_status.get(status, set()).discard(user_id)
+        self.by_module.get(module, set()).discard(user_id)
+        self.with_photo.discard(user_id)
+        if deadline is not None:
+            i = bisect_left(self._deadlines, (deadline, user_id))
+            if i < len(self._deadlines) and self._deadlines[i] == (deadline, user_id):
+                del self._deadlines[i]
+
+    def _count(self, values: _IndexedValues, sign: int) -> None:
+        """Add (sign=+1) or withdraw (sign=-1) one user's dashboard counters."""
+        level, active_day, correct, wrong = values[4:]
+        self.by_level[level] = self.by_level.get(level, 0) + sign
+        if active_day is not None:
+            self._active_days[active_day] = self._active_days.get(active_day, 0) + sign
+            if not self._active_days[active_day]:
+                del self._active_days[active_day]
+        self._quiz_correct += sign * correct
+        self._quiz_wrong += sign * wrong
+        if correct + wrong:
+            self._accuracy_sum += sign * correct / (correct + wrong)
+            self._accuracy_users += sign
+
+    def summary(self, now: Optional[datetime] = None, today: Optional[date] = None) -> Dict[str, Any]:
+        """Dashboard counters; cost does not depend on the number of users.
+
+        `now` (UTC) cuts expired deadlines; `today` (local) dates streaks,
+        matching how progress.update_streak stamps last_active_date.
+        """
+        now = now or datetime.utcnow()
+        today = today or date.today()
+        yesterday = (today - timedelta(days=1)).isoformat()
+        answered = self._quiz_correct + self._quiz_wrong
+        return {
+            "users": len(self._values),
+            "by_module": {m: len(ids) for m, ids in sorted(self.by_module.items()) if ids},
+            "by_level": {lvl: n for lvl, n in sorted(self.by_level.items()) if n},
+            "pending": len(self.by_status.get("pending", ())),
+            "expired": bisect_left(self._deadlines, (now,)),
+            # A streak survives if the last visit was today or yesterday
+            "active_streaks": self._active_days.get(today.isoformat(), 0) + self._active_days.get(yesterday, 0),
+            "quiz_accuracy_avg": round(self._accuracy_sum / self._accuracy_users * 100, 1) if self._accuracy_users else None,
+            "quiz_accuracy_overall": round(self._quiz_correct / answered * 100, 1) if answered else None,
+        }
+
+    def expired(self, now: Optional[datetime] = None) -> Set[int]:
+        """Users whose deadline is already in the past."""
+        cut = bisect_left(self._deadlines, (now or datetime.utcnow(),))
+        return {uid for _dl, uid in self._deadlines[:cut]}
+
+    def query(self, homework_status: Optional[str] = None, module_index: Optional[int] = None,
+              expired: Optional[bool] = None, has_photo: Optional[bool] = None) -> Set[int]:
+        """User ids matching every given filter (None = not filtered)."""
+        result: Optional[Set[int]] = None
+
+        def narrow(ids: Set[int], keep: bool = True) -> None:
+            nonlocal result
+            if keep:
+                result = set(ids) if result is None else result & ids
+            else:
+                result = (set(self._values) if result is None else result) - ids
+
+        if homework_status is not None:
+            narrow(self.by_status.get(homework_status, set()))
+        if module_index is not None:
+            narrow(self.by_module.get(module_index, set()))
+        if has_photo is not None:
+            narrow(self.with_photo, has_photo)
+        if expired is not None:
+            narrow(self.expired(), expired)
+        return set(self._values) if result is None else result
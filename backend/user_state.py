@@ -0,0 +1,207 @@
+"""
+user_state.py — Slotted per-user records.
+
+UserState, PetState and DnaStats replace the free-form dicts kept in
+progress.user_progress. Known fields live in __slots__, defaults are filled
+once by from_dict(), and to_dict() is the codec used for persistence and API
+responses. The mapping methods (state["xp"], .get, .setdefault, .update)
+keep dict-style call sites working; keys outside the schema go to a small
+overflow dict so nothing read from disk is dropped.
+"""
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+_MISSING = object()
+
+
+# Bumped whenever a stored record needs a one-time upgrade at load time
+# (see progress._MIGRATIONS). New records are created at this version.
+SCHEMA_VERSION = 1
+
+
+def _utcnow_iso() -> str:
+    return datetime.utcnow().isoformat()
+
+
+class _Record:
+    """Base for slotted records with a dict-compatible surface."""
+
+    __slots__ = ("_extra",)
+
+    _FIELDS: Tuple[str, ...] = ()
+    _FIELD_SET: frozenset = frozenset()
+    # field → default value, or a zero-argument factory for mutable defaults
+    _DEFAULTS: Dict[str, Any] = {}
+    # field → nested record class decoded from a dict
+    _NESTED: Dict[str, type] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls._FIELDS)
+
+    def __init__(self, **values: Any):
+        self._extra: Optional[Dict[str, Any]] = None
+        for name in self._FIELDS:
+            value = values.pop(name, _MISSING)
+            setattr(self, name, self._default(name) if value is _MISSING else value)
+        if values:
+            self._extra = values
+
+    @classmethod
+    def _default(cls, name: str) -> Any:
+        default = cls._DEFAULTS.get(name)
+        return default() if callable(default) else default
+
+    # ── codec ────────────────────────────────────────────────────────────────
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]):
+        """Decode a stored dict; missing fields get their defaults."""
+        obj = cls.__new__(cls)
+        obj._extra = None
+        for name in cls._FIELDS:
+            value = data.get(name, _MISSING)
+            if value is _MISSING:
+                value = cls._default(name)
+            else:
+                nested = cls._NESTED.get(name)
+                if nested is not None and isinstance(value, dict):
+                    value = nested.from_dict(value)
+            setattr(obj, name, value)
+        extra = {k: v for k, v in data.items() if k not in cls._FIELD_SET}
+        if extra:
+            obj._extra = extra
+        return obj
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Encode as a plain JSON-ready dict (nested records included)."""
+        out = {}
+        for name in self._FIELDS:
+            value = getattr(self, name)
+            out[name] = value.to_dict() if isinstance(value, _Record) else value
+        if self._extra:
+            out.update(self._extra)
+        return out
+
+    # ── mapping compatibility ────────────────────────────────────────────────
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._FIELD_SET:
+            return getattr(self, key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key in self._FIELD_SET:
+            nested = self._NESTED.get(key)
+            if nested is not None and isinstance(value, dict):
+                value = nested.from_dict(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._FIELD_SET or (self._extra is not None and key in self._extra)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key: str, default: Any = _MISSING) -> Any:
+        """Remove an overflow key, or reset a schema field to its default."""
+        if key in self._FIELD_SET:
+            value = getattr(self, key)
+            setattr(self, key, self._default(key))
+            return value
+        if self._extra is not None and key in self._extra:
+            return self._extra.pop(key)
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def update(self, values: Dict[str, Any]) -> None:
+        for key, value in values.items():
+            self[key] = value
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class PetState(_Record):
+    """SMC Fox companion stats."""
+
+    _FIELDS = (
+        "hunger", "happiness", "health", "pet_xp", "pet_level", "coins",
+        "last_updated", "last_tap", "tap_combo", "tap_combo_start", "total_taps",
+        "visual_state", "next_level_xp", "current_level_xp",
+        "evolution_stage", "oracle_correct", "oracle_viewed_today", "last_dream_shown",
+    )
+    __slots__ = _FIELDS
+    _DEFAULTS = {
+        "hunger": 80, "happiness": 80, "health": 100,
+        "pet_xp": 0, "pet_level": 1, "coins": 0,
+        "last_updated": _utcnow_iso,
+        "tap_combo": 0, "total_taps": 0,
+        "current_level_xp": 0,
+        "evolution_stage": 1, "oracle_correct": 0, "oracle_viewed_today": False,
+    }
+
+
+class DnaStats(_Record):
+    """Lightweight learning/trading behaviour counters."""
+
+    _FIELDS = (
+        "quiz_correct", "quiz_wrong", "total_taps",
+        "pred_correct", "pred_wrong", "lessons_studied",
+    )
+    __slots__ = _FIELDS
+    _DEFAULTS = {
+        "quiz_correct": 0, "quiz_wrong": 0, "total_taps": 0,
+        "pred_correct": 0, "pred_wrong": 0, "lessons_studied": dict,
+    }
+
+
+class UserState(_Record):
+    """One student's course progress, streak, badges, pet and DNA."""
+
+    _FIELDS = (
+        "name", "xp", "level", "rank", "module_index",
+        "completed_quests", "active_quest",
+        "homework_status", "homework_comment", "homework_photo",
+        "module_deadline", "deadline_extensions", "quiz_state",
+        "streak", "last_active_date", "badges", "daily_bonus_claimed",
+        "module_unlocked", "last_online", "pet", "dna", "schema_version",
+        "xp_days",
+    )
+    __slots__ = _FIELDS
+    _DEFAULTS = {
+        "xp": 0, "level": 1, "rank": "Наблюдатель рынка", "module_index": 0,
+        "completed_quests": list,
+        "homework_status": "idle", "homework_comment": "",
+        "deadline_extensions": 0,
+        "streak": 0, "badges": list,
+        "module_unlocked": lambda: [0],   # free module always unlocked
+        "pet": PetState, "dna": DnaStats,
+        "schema_version": SCHEMA_VERSION,
+        "xp_days": dict,   # ISO date → XP gained that day (rolling history)
+    }
+    _NESTED = {"pet": PetState, "dna": DnaStats}
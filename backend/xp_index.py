@@ -0,0 +1,125 @@
+"""
+xp_index.py — Sorted in-memory XP ranking.
+
+Users are kept in a list sorted by the key (-xp, user_id), so the order is
+XP descending with ties broken by id. The list is located with bisect on
+each update. Reading the top N is a slice, and a user's rank is one bisect.
+progress.py updates the index wherever XP changes. `version` grows on every
+change and serves as the leaderboard ETag.
+
+select_top() is a quickselect for rankings that are not indexed (the
+rolling weekly/monthly totals): it finds the k best in O(n) on average
+without sorting the population.
+"""
+import random
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class XpIndex:
+    """Leaderboard order maintained incrementally."""
+
+    __slots__ = ("_keys", "_xp", "version")
+
+    def __init__(self):
+        self._keys: List[Tuple[int, int]] = []   # (-xp, user_id), ascending
+        self._xp: Dict[int, int] = {}
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._xp
+
+    def rebuild(self, items: Iterable[Tuple[int, int]]) -> None:
+        """Replace the index with (user_id, xp) pairs (used after a load)."""
+        self._xp = {uid: int(xp) for uid, xp in items}
+        self._keys = sorted((-xp, uid) for uid, xp in self._xp.items())
+        self.version += 1
+
+    def touch(self) -> None:
+        """Bump the version for a change outside the order (e.g. a displayed name)."""
+        self.version += 1
+
+    def update(self, user_id: int, xp: int) -> None:
+        """Insert a user or move them to their new XP position."""
+        xp = int(xp)
+        old = self._xp.get(user_id)
+        if old == xp:
+            return
+        if old is not None:
+            self._discard(old, user_id)
+        self._xp[user_id] = xp
+        insort(self._keys, (-xp, user_id))
+        self.version += 1
+
+    def remove(self, user_id: int) -> None:
+        old = self._xp.pop(user_id, None)
+        if old is not None:
+            self._discard(old, user_id)
+            self.version += 1
+
+    def _discard(self, xp: int, user_id: int) -> None:
+        i = bisect_left(self._keys, (-xp, user_id))
+        if i < len(self._keys) and self._keys[i] == (-xp, user_id):
+            del self._keys[i]
+
+    def top(self, limit: int, offset: int = 0) -> List[Tuple[int, int]]:
+        """(user_id, xp) pairs in leaderboard order, starting at `offset`."""
+        return [(uid, -neg) for neg, uid in self._keys[offset:offset + limit]]
+
+    def ids(self, descending: bool = True) -> Iterator[int]:
+        """User ids in leaderboard order (or reversed), produced lazily."""
+        keys = self._keys if descending else reversed(self._keys)
+        return (uid for _neg, uid in keys)
+
+    def after(self, xp: int, user_id: int, limit: int) -> List[Tuple[int, int]]:
+        """Next `limit` pairs ranked strictly below the (xp, user_id) cursor."""
+        start = bisect_right(self._keys, (-xp, user_id))
+        return [(uid, -neg) for neg, uid in self._keys[start:start + limit]]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """1-based leaderboard position, or None if the user is not indexed."""
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return None
+        return bisect_left(self._keys, (-xp, user_id)) + 1
+
+    def around(self, user_id: int, k: int) -> List[Tuple[int, int]]:
+        """Up to k users on each side of `user_id`, the user included."""
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - k)
+        return self.top(rank + k - start, offset=start)
+
+
+def select_top(pairs: Iterable[Tuple[int, int]], k: int) -> List[Tuple[int, int]]:
+    """The k best (user_id, xp) pairs by (xp desc, user_id asc), unordered.
+
+    Quickselect: each round partitions around a random pivot and keeps only
+    the side that still contains the k-th element.
+    """
+    items = [(-xp, uid) for uid, xp in pairs]
+    if k <= 0:
+        return []
+    if k >= len(items):
+        return [(uid, -neg) for neg, uid in items]
+    chosen: List[Tuple[int, int]] = []
+    while k > 0:
+        pivot = random.choice(items)
+        better = [it for it in items if it < pivot]
+        if len(better) >= k:
+            items = better
+            continue
+        chosen.extend(better)
+        k -= len(better)
+        equal = [it for it in items if it == pivot]
+        if len(equal) >= k:
+            chosen.extend(equal[:k])
+            break
+        chosen.extend(equal)
+        k -= len(equal)
+        items = [it for it in items if it > pivot]
+    return [(uid, -neg) for neg, uid in chosen]